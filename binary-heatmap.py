@@ -9,6 +9,12 @@
 # $ perf script -F time,ip,dso > data
 # $ ./binary-heatmap.py data gcc10-reorder-heatmap.png cc1plus --title 'GCC 10-reorder' --mapfile mapfile.txt
 #
+# With millions of samples, add --raster to draw sample density instead of every sample.
+#
+# Alternatively (or in addition to the mapfile), functions can be read from the symbol table
+# of the (non-PIE) binary itself:
+# $ ./binary-heatmap.py data gcc10-reorder-heatmap.png cc1plus --elf /tmp/gcc10-cc1plus
+#
 # Sample of perf script file:
 # 2415.281677:            e18b08 (/tmp/gcc10-cc1plus)
 # 2415.281763:            e35e7f (/tmp/gcc10-cc1plus)
@@ -21,8 +27,18 @@ import matplotlib.ticker as ticker
 import subprocess
 import re
 from itertools import chain
+from matplotlib.colors import LogNorm
 from matplotlib.lines import Line2D
-from itertools import dropwhile, takewhile
+
+# perf script output is parsed in chunks of this many bytes
+CHUNK_SIZE = 16 * 1024**2
+
+# value of a hexadecimal digit for every byte, NUL (string padding) is -1
+HEX_VALUES = np.full(256, -1, dtype = np.int64)
+for i, c in enumerate(b'0123456789abcdef'):
+    HEX_VALUES[c] = i
+for i, c in enumerate(b'ABCDEF'):
+    HEX_VALUES[c] = 10 + i
 
 class MapComponent:
     def __init__(self, name, lines):
@@ -43,21 +59,174 @@ class MapComponent:
         else:
             return None
 
-def get_symbol_for_sample(symbols, address):
-    mid = round(len(symbols) / 2)
-    item = symbols[mid]
-    a = item['address']
-    s = item['size']
-    if (a <= address and address < (a + s)):
-        return item
-    elif len(symbols) == 1:
-        return None
-    elif address < a:
-        return get_symbol_for_sample(symbols[:mid], address)
-    else:
-        return get_symbol_for_sample(symbols[mid:], address)
-
-def parse_gold_mapfile(filename, sample_addresses):
+def no_samples():
+    return (np.array([], dtype = np.float64), np.array([], dtype = np.uint64))
+
+def token_matrix(buffer, starts, ends):
+    # one row per token, padded with NUL bytes
+    width = max((ends - starts).max(), 1)
+    index = starts[:, None] + np.arange(width)
+    inside = index < ends[:, None]
+    return np.where(inside, buffer[np.minimum(index, len(buffer) - 1)], 0).astype(np.uint8)
+
+def parse_hex(digits):
+    # all rows are converted at once, column by column
+    result = np.zeros(len(digits), dtype = np.uint64)
+    for column in digits.T:
+        value = HEX_VALUES[column]
+        assert (value[column != 0] >= 0).all()
+        result = np.where(value >= 0, (result << np.uint64(4)) | value.astype(np.uint64), result)
+    return result
+
+def parse_perf_chunk(data, needle):
+    # a line is: '<time>: <address> (<binary>)', split it to tokens without creating Python objects
+    buffer = np.frombuffer(data, dtype = np.uint8)
+    if len(buffer) < len(needle):
+        return no_samples()
+    # spaces, tabs and newlines are the only bytes below '!'
+    word = np.concatenate(([False], buffer > ord(' '), [False]))
+    starts = np.flatnonzero(word[1:] & ~word[:-1])
+    ends = np.flatnonzero(word[:-1] & ~word[1:])
+    assert len(starts) % 3 == 0
+    starts = starts.reshape(-1, 3)
+    ends = ends.reshape(-1, 3)
+
+    # find the needle in the whole chunk and keep lines where it is a part of the binary name
+    needle = np.frombuffer(needle.encode(), dtype = np.uint8)
+    found = np.ones(len(buffer) - len(needle) + 1, dtype = bool)
+    for i, c in enumerate(needle):
+        found &= buffer[i:len(buffer) - len(needle) + 1 + i] == c
+    positions = np.flatnonzero(found)
+    lines = np.searchsorted(starts[:, 2], positions, side = 'right') - 1
+    valid = lines >= 0
+    valid[valid] = positions[valid] + len(needle) <= ends[lines[valid], 2]
+    selected = np.zeros(len(starts), dtype = bool)
+    selected[lines[valid]] = True
+    if not selected.any():
+        return no_samples()
+    starts = starts[selected]
+    ends = ends[selected]
+
+    assert (buffer[ends[:, 0] - 1] == ord(':')).all()
+    times = token_matrix(buffer, starts[:, 0], ends[:, 0] - 1)
+    # trailing NUL bytes are ignored by the conversion
+    times = times.view('S%d' % times.shape[1]).ravel().astype(np.float64)
+    return (times, parse_hex(token_matrix(buffer, starts[:, 1], ends[:, 1])))
+
+def read_perf_script(filename, needle):
+    times = []
+    addresses = []
+    with open(filename, 'rb') as f:
+        rest = b''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            # parse only complete lines, the rest goes to the next chunk
+            chunk = rest + data
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            chunk = chunk[:end]
+            if chunk:
+                t, a = parse_perf_chunk(chunk, needle)
+                times.append(t)
+                addresses.append(a)
+        if rest.strip():
+            t, a = parse_perf_chunk(rest, needle)
+            times.append(t)
+            addresses.append(a)
+    if not times:
+        return no_samples()
+    return (np.concatenate(times), np.concatenate(addresses))
+
+def symbol_index(starts, ends, sample_addresses):
+    # symbols are sorted by address, find the last one starting before every sample
+    index = np.searchsorted(starts, sample_addresses, side = 'right') - 1
+    inside = index >= 0
+    inside[inside] = sample_addresses[inside] < ends[index[inside]]
+    index[~inside] = -1
+    return index
+
+def count_symbol_samples(starts, ends, sample_addresses):
+    index = symbol_index(starts, ends, sample_addresses)
+    return np.bincount(index[index >= 0], minlength = len(starts))
+
+def read_elf_symbols(filename):
+    symbols = {}
+    output = subprocess.check_output(['nm', '--print-size', '--demangle', '--defined-only', filename], text = True)
+    for line in output.splitlines():
+        # address, size, type and name; symbols without a size are skipped
+        parts = line.split(maxsplit = 3)
+        if len(parts) != 4 or parts[2] not in ('t', 'T', 'W'):
+            continue
+        address = int(parts[0], 16)
+        size = int(parts[1], 16)
+        # aliases share the address, keep the biggest one
+        if size and symbols.get(address, (0, ))[0] < size:
+            symbols[address] = (size, parts[3])
+
+    starts = np.array(sorted(symbols), dtype = np.uint64)
+    ends = starts + np.array([symbols[a][0] for a in starts.tolist()], dtype = np.uint64)
+    names = [symbols[a][1] for a in starts.tolist()]
+    return (starts, ends, names)
+
+def read_elf_sections(filename):
+    sections = []
+    # [Nr] Name Type Address Off Size ES Flg Lk Inf Al
+    pattern = re.compile(r'\s*\[\s*\d+\]\s+(\S+)\s+\S+\s+(\w+)\s+\w+\s+(\w+)\s+\w+\s+(\S*)')
+    for line in subprocess.check_output(['readelf', '--section-headers', '--wide', filename], text = True).splitlines():
+        m = pattern.match(line)
+        if m and 'X' in m.group(4):
+            start = int(m.group(2), 16)
+            size = int(m.group(3), 16)
+            if size:
+                sections.append((m.group(1), start, start + size))
+    return sections
+
+def print_function_hotness(starts, ends, names, counts, ranges, total, n):
+    print('Attributed %d samples (%.2f%%) to %d functions' % (counts.sum(), 100.0 * counts.sum() / total, len(starts)))
+    print('Top %d functions:' % n)
+    print('%10s %7s %10s %11s  %-16s %s' % ('samples', '%', 'size', 'samples/KB', 'subsection', 'function'))
+    for i in np.argsort(counts, kind = 'stable')[::-1][:n]:
+        if not counts[i]:
+            break
+        size = int(ends[i] - starts[i])
+        subsection = next((r[0] for r in ranges if r[1] <= starts[i] < r[2]), '')
+        print('%10d %6.2f%% %10d %11.2f  %-16s %s' % (counts[i], 100.0 * counts[i] / total, size,
+                                                   1024.0 * counts[i] / size, subsection, names[i]))
+
+def print_layout_score(starts, ends, counts, sample_addresses, size_mb):
+    # attributed samples in the densest 1 MB windows of the address space
+    window = (sample_addresses >> np.uint64(20)).astype(np.int64)
+    windows = np.sort(np.bincount(window - window.min()))[::-1]
+    actual = windows[:size_mb].sum() / len(sample_addresses)
+
+    # the best layout puts functions with the most samples per byte next to each other
+    sizes = (ends - starts).astype(np.float64)
+    order = np.argsort(-counts / sizes, kind = 'stable')
+    best = np.interp(size_mb * 1024**2, np.concatenate(([0], np.cumsum(sizes[order]))),
+                     np.concatenate(([0], np.cumsum(counts[order])))) / len(sample_addresses)
+    print('Attributed samples in the densest %d MB: %.2f%% (best function order: %.2f%%), layout score: %.2f'
+          % (size_mb, 100 * actual, 100 * best, actual / best if best else 0))
+
+def bin_index(values, count, low, high):
+    # bins are uniform, compute the bin of a sample instead of searching the edges
+    if high <= low:
+        high = low + 1
+    values = values.astype(np.float64)
+    index = np.floor((values - low) * (count / (high - low))).astype(np.int64)
+    index[values == high] = count - 1
+    index[(index < 0) | (index >= count)] = -1
+    return index
+
+def density(x, y, resolution, x_range, y_range):
+    columns = bin_index(x, resolution[0], *x_range)
+    rows = bin_index(y, resolution[1], *y_range)
+    inside = (columns >= 0) & (rows >= 0)
+    counts = np.bincount(rows[inside] * resolution[0] + columns[inside], minlength = resolution[0] * resolution[1])
+    return counts.reshape(resolution[1], resolution[0])
+
+def parse_gold_mapfile(lines, sample_addresses):
     text_start = None
     text_unlikely_start = None
     text_startup_start = None
@@ -65,7 +234,6 @@ def parse_gold_mapfile(filename, sample_addresses):
     text_hot_end = None
     text_end = None
 
-    lines = open(filename).read().splitlines()
     for i, line in enumerate(lines):
         parts = line.split()
 
@@ -108,7 +276,7 @@ def parse_gold_mapfile(filename, sample_addresses):
 
     return [c.get_address_range() for c in result if c.get_address_range()]
 
-def parse_bfd_mapfile(filename, sample_addresses):
+def parse_bfd_mapfile(lines, sample_addresses):
     components = []
     map_components = [
         (' *(.text.unlikely .text.*_unlikely .text.unlikely.*)', '.text.unlikely'),
@@ -121,16 +289,17 @@ def parse_bfd_mapfile(filename, sample_addresses):
         ('.gnu.attributes', None)
     ]
 
-    lines = [l.rstrip() for l in open(filename)]
+    # find all components in a single pass and filter map_components to existing one
+    headers = {mc[0] for mc in map_components}
+    positions = {}
+    for i, l in enumerate(lines):
+        if l in headers and l not in positions:
+            positions[l] = i
+    map_components = [mc for mc in map_components if mc[0] in positions]
 
-    # filter map_components to existing one
-    map_components = [mc for mc in map_components if mc[0] in lines]
-
-    lines = list(dropwhile(lambda x: x != map_components[0][0], lines))
     for i in range(0, len(map_components) - 1):
-        chunk = list(takewhile(lambda x: x != map_components[i+1][0], lines))
+        chunk = lines[positions[map_components[i][0]]:positions[map_components[i + 1][0]]]
         components.append(MapComponent(map_components[i][1], chunk))
-        lines = lines[len(chunk):]
 
     components[-1].start = components[-1].addresses[0]
     end = components[-1].start
@@ -158,31 +327,29 @@ def parse_bfd_mapfile(filename, sample_addresses):
             s['size'] = 0
 
     print('Found %d symbols in .text.unlikely subsection' % len(unlikely_symbols))
-    unlikely_accesses = 0
-    unlikely_dict = {}
-    for address in sample_addresses:
-        symbol = get_symbol_for_sample(unlikely_symbols, address)
-        if symbol != None:
-            if not symbol['name'] in unlikely_dict:
-                unlikely_dict[symbol['name']] = 0
-            unlikely_dict[symbol['name']] += 1
-            unlikely_accesses += 1
+    starts = np.array([s['address'] for s in unlikely_symbols], dtype = np.uint64)
+    ends = starts + np.array([s['size'] for s in unlikely_symbols], dtype = np.uint64)
+    counts = count_symbol_samples(starts, ends, sample_addresses)
+    unlikely_accesses = counts.sum()
 
     N = 20
     print('Total accessses in .text.unlikely: %d' % unlikely_accesses)
     print('Top %d accessses in .text.unlikely section:' % N)
-    for k, v in list(reversed(sorted(unlikely_dict.items(), key = lambda x: x[1])))[:N]:
-        print('  %s: %d' % (k, v))
+    for i in np.argsort(counts, kind = 'stable')[::-1][:N]:
+        if counts[i]:
+            print('  %s: %d' % (unlikely_symbols[i]['name'], counts[i]))
 
     return [c.get_address_range() for c in components if c.get_address_range()]
 
 def parse_mapfile(filename, sample_addresses):
-    if '.note.gnu.gold-version' in open(filename).read():
+    content = open(filename).read()
+    lines = [l.rstrip() for l in content.splitlines()]
+    if '.note.gnu.gold-version' in content:
         print('Parsing ld.gold format mapfile')
-        return parse_gold_mapfile(filename, sample_addresses)
+        return parse_gold_mapfile(lines, sample_addresses)
     else:
         print('Parsing ld.bfd format mapfile')
-        return parse_bfd_mapfile(filename, sample_addresses)
+        return parse_bfd_mapfile(lines, sample_addresses)
 
 @ticker.FuncFormatter
 def major_formatter(x, pos):
@@ -196,42 +363,42 @@ parser.add_argument('--title', help = 'Title')
 parser.add_argument('--max-x', help = 'Maximum value on x axis', type = int)
 parser.add_argument('--max-y', help = 'Maximum value on y axis', type = int)
 parser.add_argument('--mapfile', help = 'ld mapfile')
+parser.add_argument('--elf', help = 'profiled binary, samples are attributed to functions of its symbol table')
+parser.add_argument('--top', help = 'number of functions in the hotness table', type = int, default = 20)
+parser.add_argument('--layout-mb', help = 'size of the hot region for the layout score (in MB)', type = int,
+                    default = 2)
 parser.add_argument('--pointsize', help = 'graph point size', type = float, default = 0.2)
 parser.add_argument('--pointalpha', help = 'graph point alpha', type = float, default = 0.2)
+parser.add_argument('--raster', help = 'draw sample density instead of individual samples', action = 'store_true')
+parser.add_argument('--resolution', help = 'number of time and address bins of the raster', type = int, nargs = 2,
+                    default = [2000, 1000], metavar = ('TIME', 'ADDRESS'))
 args = parser.parse_args()
 
-values = [l.strip() for l in open(args.perf_stat_file).readlines()]
-
 print('Reading perf events for binary name: %s' % args.needle)
 
-x = []
-y = []
-
-for value in values:
-    parts = [p for p in value.split(' ') if p]
-
-    time = float(parts[0][:-1])
-    address = int(parts[1], 16)
-    binary = parts[2]
-
-    if args.needle in binary:
-        x.append(time)
-        y.append(address)
-    assert len(parts) == 3
+x, y = read_perf_script(args.perf_stat_file, args.needle)
 
 print('Found %d events' % len(x))
 if len(x) == 0:
     print('Error: no events')
     exit(1)
 
-first_time = x[0]
-for i in range(len(x)):
-    x[i] -= first_time
+x -= x[0]
 
 fig, (ax1, ax2) = plt.subplots(1, 2, sharey='row', gridspec_kw={'hspace': 5, 'wspace': 0.05}, figsize=(10, 5))
 fig.suptitle(args.title)
 
-ax1.scatter(x, y, s = args.pointsize, c='green', alpha=args.pointalpha, edgecolors='none', marker='s')
+if args.raster:
+    x_range = (0, args.max_x if args.max_x else x.max())
+    y_range = (int(y.min()), args.max_y if args.max_y else int(y.max()) + 1)
+    image = density(x, y, args.resolution, x_range, y_range)
+    print('Drawing %dx%d raster, at most %d samples in a bin' % (args.resolution[0], args.resolution[1], image.max()))
+    # empty bins are masked by the log scale and stay transparent
+    mappable = ax1.imshow(image, origin = 'lower', aspect = 'auto', interpolation = 'nearest', cmap = 'viridis',
+                          norm = LogNorm(vmin = 1), extent = x_range + y_range)
+    fig.colorbar(mappable, ax = [ax1, ax2], label = 'Samples', pad = 0.01)
+else:
+    ax1.scatter(x, y, s = args.pointsize, c='green', alpha=args.pointalpha, edgecolors='none', marker='s')
 ax1.grid(True, linewidth = 0.5, alpha = 0.3)
 ax1.set_ylabel('Address (in MB)')
 ax1.set_xlabel('Time')
@@ -239,7 +406,8 @@ ax1.yaxis.set_major_formatter(major_formatter)
 ax1.yaxis.set_major_locator(ticker.MultipleLocator(2 * 1024**2))
 ax1.set_title('Executed instruction address')
 
-ax2.hist(y, 300, orientation='horizontal', color='green')
+counts, edges = np.histogram(y, 300)
+ax2.stairs(counts, edges, orientation='horizontal', fill=True, color='green')
 ax2.set_title('Virtual address histogram')
 ax2.set_xlabel('Sample count')
 
@@ -249,20 +417,39 @@ if args.max_x:
 if args.max_y:
     ax1.set_ylim((0, args.max_y))
 
+ranges = []
 if args.mapfile:
     ranges = parse_mapfile(args.mapfile, y)
 
+if args.elf:
+    sections = read_elf_sections(args.elf)
+    # without a mapfile, show the executable sections
+    if not ranges:
+        ranges = sections
+    starts, ends, names = read_elf_symbols(args.elf)
+    print('Found %d functions in %s' % (len(starts), args.elf))
+    index = symbol_index(starts, ends, y)
+    counts = np.bincount(index[index >= 0], minlength = len(starts))
+    print_function_hotness(starts, ends, names, counts, ranges, len(y), args.top)
+    if counts.any():
+        print_layout_score(starts, ends, counts, y[index >= 0], args.layout_mb)
+
+if ranges:
     colors = 'cmrkby'
     custom_lines = []
     print('Found ELF .text subsections: %s' % str(ranges))
     alpha = .1
     for i, r in enumerate(ranges):
-        samples = len([a for a in y if r[1] <= a and a <= r[2]])
+        samples = np.count_nonzero((y >= r[1]) & (y <= r[2]))
         fraction = (100.0 * samples / len(x))
         size = 1.0 * (r[2] - r[1]) / (1024**2)
-        custom_lines.append(Line2D([0], [0], color=colors[i], alpha=0.1, lw=4, label= r[0] + ' (size: %.2f MB; samples: %d (%.2f%%))' % (size, samples, fraction)))
-        ax1.axhspan(r[1], r[2], facecolor=colors[i], alpha=alpha)
-        ax2.axhspan(r[1], r[2], facecolor=colors[i], alpha=alpha)
+        custom_lines.append(Line2D([0], [0], color=colors[i % len(colors)], alpha=0.1, lw=4, label= r[0] + ' (size: %.2f MB; samples: %d (%.2f%%))' % (size, samples, fraction)))
+        if args.raster:
+            # a tinted span would change colors of the raster, outline the subsection instead
+            ax1.axhspan(r[1], r[2], facecolor='none', edgecolor=colors[i % len(colors)], lw=0.5)
+        else:
+            ax1.axhspan(r[1], r[2], facecolor=colors[i % len(colors)], alpha=alpha)
+        ax2.axhspan(r[1], r[2], facecolor=colors[i % len(colors)], alpha=alpha)
     fig.legend(handles=list(reversed(custom_lines)), loc = 'upper left', prop={'size': 6})
 
 plt.savefig(args.output_image, dpi = 800)
@@ -6,15 +6,23 @@ import os
 import shutil
 import stat
 import subprocess
-import tempfile
+import tarfile
 import time
 from pathlib import Path
 
 from git import Repo
 
+import psutil
+
 
 CHUNK_SIZE = 100
 COMPRESSION_LEVEL = 17
+# initial guess of /dev/shm space needed by a chunk, refined by the finished chunks
+CHUNK_SHM_ESTIMATE = 10 * 1024 ** 3
+# memory needed by 'elfshaker pack' on top of the chunk's /dev/shm data
+PACK_MEMORY = 4 * 1024 ** 3
+MAX_WORKERS = os.cpu_count()
+POLL_INTERVAL = 10
 last_revision = '1a46d358050cf6964df0d8ceaffafd0cc88539b2'
 repo = Repo('/home/marxin/Programming/gcc2')
 binaries_dir = '/DATA/gcc-binaries'
@@ -22,6 +30,8 @@ elfshaker_bin = '/home/marxin/Programming/elfshaker/target/release/elfshaker'
 elfshaker_repo = Path('/home/marxin/elfshaker-gcc-binaries')
 elfshaker_packs = elfshaker_repo / 'elfshaker_data' / 'packs'
 tmpdir = Path('/dev/shm/tmp-elfshaker')
+# keep symlinks and modes exactly as they are in our own tarballs
+EXTRACT_ARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
 
 revisions = [x.hexsha for x in reversed(list(repo.iter_commits(last_revision + '..origin/master', first_parent=True)))]
 print(f'Have: {len(revisions)} revisions')
@@ -85,63 +95,118 @@ f00b5710a30f22efc3171c393e56aeb335c3cd39
 """
 
 
-def detect_file_metainfo(folder):
-    symlinks = {}
-    executables = []
+def unpack_tarball(tarball, folder):
+    """Decompress and unpack the tarball in a single streaming pass.
 
+    File metainfo is collected from the tar headers instead of walking the unpacked tree.
+    """
+    symlinks = {}
+    modes = {}
+    size = 0
+
+    with subprocess.Popen(['zstd', '-T0', '-d', '-c', tarball], stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as proc:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            for member in tar:
+                name = os.path.join('.', os.path.normpath(member.name))
+                if member.issym():
+                    symlinks[name] = member.linkname
+                elif member.isfile() or member.islnk():
+                    modes[name] = member.mode
+                size += member.size
+                tar.extract(member, folder, **EXTRACT_ARGS)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    executables = [name for name, mode in modes.items() if mode & stat.S_IXUSR]
+    # a symlink to an executable is an executable as well
+    for name, target in symlinks.items():
+        resolved = os.path.join('.', os.path.normpath(os.path.join(os.path.dirname(name), target)))
+        if modes.get(resolved, 0) & stat.S_IXUSR:
+            executables.append(name)
+
+    return ({'symlinks': symlinks, 'executables': sorted(executables)}, size)
+
+
+def folder_size(folder):
+    size = 0
     for root, _, files in os.walk(folder):
         for file in files:
-            path = Path(root, file)
-            if path.is_symlink():
-                symlinks[str(path)] = str(path.readlink())
-            if path.stat().st_mode & stat.S_IXUSR:
-                executables.append(str(path))
-
-    return {'symlinks': symlinks, 'executables': sorted(executables)}
-
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return size
 
-def pack_revisions(n, revisions):
-    if n < 4:
-        delay = 30 * n
-        print(f'Sleeping for {delay} s', flush=True)
-        time.sleep(delay)
-        print(f'Starting {n} after sleeping')
 
+def pack_revisions(n, revisions, tempdir):
     start = time.monotonic()
-    tempdir = tempfile.mkdtemp(dir=tmpdir)
+    # a crashed run leaves its chunk folder behind
+    shutil.rmtree(tempdir, ignore_errors=True)
+    tempdir.mkdir()
     os.chdir(tempdir)
-    print(f'Packing {n} in {tempdir}')
+    print(f'Packing {n} in {tempdir}', flush=True)
+    unpacked = 0
+    packed = 0
     for h in revisions:
-        archive = f'{h}.tar'
-        zstd_archive = f'{archive}.zst'
-        abs_zstd_archive = f'{binaries_dir}/{zstd_archive}'
-        if Path(abs_zstd_archive).exists():
-            shutil.copyfile(abs_zstd_archive, zstd_archive)
-            subprocess.check_output(f'zstd -T0 -d {zstd_archive} -f', shell=True, stderr=subprocess.DEVNULL)
-            subprocess.check_output(f'tar xvf {archive}', shell=True)
-            os.remove(archive)
-            os.remove(zstd_archive)
+        zstd_archive = Path(binaries_dir, f'{h}.tar.zst')
+        if zstd_archive.exists():
+            metadata, size = unpack_tarball(zstd_archive, '.')
+            unpacked += size
+            packed += 1
             with open('meta.json', 'w') as meta:
-                metadata = detect_file_metainfo('.')
                 json.dump(metadata, meta, indent=2)
             subprocess.check_output(f'/home/marxin/Programming/elfshaker/target/release/elfshaker store {h}',
                                     shell=True)
 
+    peak = folder_size(tempdir)
     packname = f'pack-{n:04}'
     subprocess.check_output(f'{elfshaker_bin} pack {packname} --compression-level {COMPRESSION_LEVEL}',
                             shell=True, stderr=subprocess.PIPE)
+    peak = max(peak, folder_size(tempdir))
     shutil.copy(f'elfshaker_data/packs/{packname}.pack', elfshaker_packs)
     shutil.copy(f'elfshaker_data/packs/{packname}.pack.idx', elfshaker_packs)
     shutil.rmtree(tempdir)
-    print(f'Packing {n} took {time.monotonic() - start:.2f}')
-
-
-with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-    futures = []
-    for i in range(revcount // CHUNK_SIZE):
-        chunk = revisions[:CHUNK_SIZE]
-        futures.append(executor.submit(pack_revisions, i, chunk))
-        revisions = revisions[CHUNK_SIZE:]
-    concurrent.futures.wait(futures)
-    for future in futures:
-        future.result()
+    took = time.monotonic() - start
+    print(f'Packing {n} took {took:.2f} s ({packed / took:.2f} revisions/s, '
+          f'{unpacked / took / 1024 ** 2:.1f} MB/s)', flush=True)
+    return peak
+
+
+def can_start_chunk(running, estimate):
+    """Check there is room for one more chunk next to the running ones."""
+    if not running:
+        return True
+    if len(running) >= MAX_WORKERS:
+        return False
+
+    # running chunks are going to grow up to the estimate
+    reserved = sum(max(estimate - folder_size(tempdir), 0) for tempdir in running.values())
+    shm_free = shutil.disk_usage(tmpdir).free - reserved
+    # /dev/shm is backed by memory
+    memory_free = psutil.virtual_memory().available - reserved - PACK_MEMORY * len(running)
+    return shm_free >= estimate and memory_free >= estimate + PACK_MEMORY
+
+
+# the last chunk can be smaller than CHUNK_SIZE
+chunks = [revisions[i:i + CHUNK_SIZE] for i in range(0, revcount, CHUNK_SIZE)]
+print(f'Packing {len(chunks)} chunks')
+start = time.monotonic()
+estimate = CHUNK_SHM_ESTIMATE
+
+with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    running = {}
+    n = 0
+    while n < len(chunks) or running:
+        while n < len(chunks) and can_start_chunk(running, estimate):
+            tempdir = tmpdir / f'chunk-{n:04}'
+            running[executor.submit(pack_revisions, n, chunks[n], tempdir)] = tempdir
+            n += 1
+        done, _ = concurrent.futures.wait(running, timeout=POLL_INTERVAL,
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            del running[future]
+            estimate = max(estimate, int(future.result() * 1.1))
+
+took = time.monotonic() - start
+print(f'Packing {revcount} revisions took {took:.2f} s ({revcount / took:.2f} revisions/s)')
@@ -1,48 +1,189 @@
 #!/usr/bin/env python3
 
-import subprocess
+import argparse
+import glob
+import os
+import re
 import time
 
 import matplotlib.pyplot as plt
+from matplotlib.ticker import MaxNLocator
 
-import psutil
+import numpy as np
 
 INTERVAL = 0.04
 FILENAME = 'cpu-frequency.svg'
-cpu_count = psutil.cpu_count()
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+parser = argparse.ArgumentParser(description='Monitor frequency and load of all CPU cores')
+parser.add_argument('-i', '--interval', type=float, default=INTERVAL,
+                    help=f'Sampling interval in seconds (default: {INTERVAL})')
+parser.add_argument('-o', '--output', default=FILENAME, help=f'Output image (default: {FILENAME})')
+args = parser.parse_args()
+
+
+def pread_all(fd):
+    """Read the whole file from its beginning, the descriptor stays open for the next sample."""
+    chunks = []
+    offset = 0
+    while chunk := os.pread(fd, 65536, offset):
+        chunks.append(chunk)
+        offset += len(chunk)
+    return b''.join(chunks)
+
+
+def read_int(path):
+    with open(path) as f:
+        return int(f.read())
+
+
+def cpu_number(path):
+    return int(re.search(r'/cpu(\d+)/', path).group(1))
+
+
+class FrequencyReader:
+    """Current frequency (in MHz) of all cores.
+
+    Reads cpufreq's scaling_cur_freq of every core from descriptors opened once;
+    without cpufreq (e.g. in a VM) the 'cpu MHz' lines of /proc/cpuinfo are used.
+    """
+
+    def __init__(self):
+        paths = sorted(glob.glob('/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'),
+                       key=cpu_number)
+        self.cores = [cpu_number(path) for path in paths]
+        self.fds = [os.open(path, os.O_RDONLY) for path in paths]
+        self.max_frequency = None
+        if paths:
+            max_paths = [path.replace('scaling_cur_freq', 'cpuinfo_max_freq') for path in paths]
+            if all(os.path.exists(path) for path in max_paths):
+                self.max_frequency = max(read_int(path) for path in max_paths) / 1000
+            self.cpuinfo = None
+        else:
+            self.cpuinfo = os.open('/proc/cpuinfo', os.O_RDONLY)
+            self.cores = list(range(len(self.read_cpuinfo())))
+
+    def read_cpuinfo(self):
+        return [float(line.split(b':')[1]) for line in pread_all(self.cpuinfo).splitlines()
+                if line.startswith(b'cpu MHz')]
+
+    def read(self):
+        if self.cpuinfo is not None:
+            return self.read_cpuinfo()
+        # the value is in kHz
+        return [int(os.pread(fd, 32, 0)) / 1000 for fd in self.fds]
+
+
+class BusyReader:
+    """Busy time (in %) of all cores since the previous read, from /proc/stat."""
+
+    def __init__(self, cores):
+        self.cores = cores
+        self.fd = os.open('/proc/stat', os.O_RDONLY)
+        self.last = self.read_ticks()
+
+    def read_ticks(self):
+        # core -> (busy ticks, total ticks)
+        ticks = {}
+        for line in pread_all(self.fd).splitlines():
+            if line.startswith(b'cpu') and line[3:4].isdigit():
+                name, *values = line.split()
+                values = [int(value) for value in values]
+                # idle and iowait
+                idle = values[3] + values[4]
+                # guest time is already accounted in user time
+                total = sum(values[:8])
+                ticks[int(name[3:])] = (total - idle, total)
+        return ticks
+
+    def read(self):
+        ticks = self.read_ticks()
+        busy = []
+        for core in self.cores:
+            last_busy, last_total = self.last.get(core, (0, 0))
+            current_busy, current_total = ticks.get(core, (0, 0))
+            total = current_total - last_total
+            busy.append(100 * (current_busy - last_busy) / total if total > 0 else 0)
+        self.last = ticks
+        return busy
+
+
+frequency_reader = FrequencyReader()
+busy_reader = BusyReader(frequency_reader.cores)
+cores = frequency_reader.cores
+print(f'Monitoring {len(cores)} cores every {args.interval} s, '
+      f'/proc/stat has a resolution of {1000 / CLOCK_TICKS:.0f} ms')
 
 times = []
-cpus = []
+busy = []
 frequencies = []
 
 start = time.monotonic()
+next_tick = start
 
 try:
     while True:
-        cpu = psutil.cpu_percent(percpu=True)[0]
-        r = subprocess.check_output('cat /proc/cpuinfo | grep MHz | head -n1',
-                                    shell=True, encoding='utf8')
-        freq = float(r.strip().split(' ')[-1])
-        d = time.monotonic() - start
-        print(f'{d:3.2f} CPU: {cpu:6.2f}%, frequency: {freq:.2f} MHz')
-        time.sleep(INTERVAL)
+        next_tick += args.interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # we are late, do not try to catch up
+            next_tick = time.monotonic()
 
+        d = time.monotonic() - start
         times.append(d)
-        cpus.append(cpu)
-        frequencies.append(freq)
+        busy.append(busy_reader.read())
+        frequencies.append(frequency_reader.read())
+        # print about once per second, every sample with longer intervals
+        if len(times) % max(1, round(1 / args.interval)) == 0:
+            print(f'{d:6.2f} s: CPU avg: {np.mean(busy[-1]):6.2f}%, frequency min/avg/max: '
+                  f'{min(frequencies[-1]):.0f}/{np.mean(frequencies[-1]):.0f}/{max(frequencies[-1]):.0f} MHz')
 except KeyboardInterrupt:
     pass
 finally:
-    print('xx')
-    plt.plot(times, cpus, label='CPU #0 usage (in %)')
-    plt.plot(times, frequencies, label='CPU #0 frequency (in MHz)')
-    plt.grid(True)
-    plt.legend()
-    for i, ts in enumerate(times):
-        if i < len(times) - 1 and abs(cpus[i] - cpus[i + 1]) > 50:
-            plt.vlines(ts, 0, 4000, linestyles='dashed', lw=1, colors='gray')
-
-    plt.title('CPU usage and frequency')
-    plt.xlabel('time (s)')
-    print('Saving to %s' % FILENAME)
-    plt.savefig(FILENAME)
+    if times:
+        # core x time
+        busy = np.array(busy).T
+        frequencies = np.array(frequencies).T
+        extent = [0, times[-1], cores[-1] + 0.5, cores[0] - 0.5]
+
+        # the second column holds the colorbars so that the time axes line up
+        fig, axes = plt.subplots(3, 2, sharex='col', gridspec_kw={'width_ratios': [40, 1], 'wspace': 0.15})
+        freq_subplot, busy_subplot, line_subplot = axes[:, 0]
+        axes[2, 1].axis('off')
+        fig.set_figheight(10)
+        fig.set_figwidth(12)
+
+        image = freq_subplot.imshow(frequencies, aspect='auto', interpolation='nearest', extent=extent,
+                                    cmap='inferno', vmax=frequency_reader.max_frequency)
+        fig.colorbar(image, cax=axes[0, 1], label='MHz')
+        freq_subplot.set_title('Frequency')
+        freq_subplot.set_ylabel('core')
+        freq_subplot.yaxis.set_major_locator(MaxNLocator(integer=True))
+
+        image = busy_subplot.imshow(busy, aspect='auto', interpolation='nearest', extent=extent,
+                                    cmap='viridis', vmin=0, vmax=100)
+        fig.colorbar(image, cax=axes[1, 1], label='%')
+        busy_subplot.set_title('Busy')
+        busy_subplot.set_ylabel('core')
+        busy_subplot.yaxis.set_major_locator(MaxNLocator(integer=True))
+
+        line_subplot.plot(times, frequencies.mean(axis=0), lw=1, label='average frequency (in MHz)')
+        line_subplot.plot(times, frequencies.min(axis=0), lw=1, label='minimal frequency (in MHz)')
+        if frequency_reader.max_frequency:
+            line_subplot.axhline(frequency_reader.max_frequency, color='r', alpha=0.5, lw=1,
+                                 linestyle='dotted', label='maximal frequency (in MHz)')
+        line_subplot.set_xlabel('time (s)')
+        line_subplot.set_ylabel('MHz')
+        line_subplot.grid(True)
+        line_subplot.legend(loc='lower left', prop={'size': 6})
+        busy_line = line_subplot.twinx()
+        busy_line.plot(times, busy.mean(axis=0), lw=1, color='gray', label='average usage (in %)')
+        busy_line.set_ylim([0, 105])
+        busy_line.set_ylabel('%')
+        busy_line.legend(loc='lower right', prop={'size': 6})
+
+        fig.suptitle('CPU usage and frequency')
+        print(f'Saving to {args.output}')
+        plt.savefig(args.output)
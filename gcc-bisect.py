@@ -8,21 +8,31 @@
 
 import argparse
 import configparser
+import contextlib
+import fcntl
+import hashlib
 import json
 import math
 import os
+import queue
 import re
+import shlex
 import shutil
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import quote
 
 import filelock
 
-from git import Repo
+from git import Commit, Repo
+from git.objects.util import from_timestamp
 
 import psutil
 
@@ -34,6 +44,15 @@ CPU_COUNT = psutil.cpu_count()
 CHUNK_SIZE = 100
 COMPRESSION_LEVEL = 17
 METAFILE = 'meta.json'
+# binary manifest: magic followed by records of (mode, name length, target length, name, target)
+MANIFEST = 'meta.bin'
+MANIFEST_MAGIC = b'GBM1'
+MANIFEST_RECORD = struct.Struct('<IHH')
+EXTRACTED_STAMP = '.gcc-bisect-extracted'
+RESULT_OUTPUT_LIMIT = 64 * 1024
+ICE_MESSAGES = ['internal compiler error', 'Fatal Error', 'Internal compiler error',
+                'Please submit a full bug report', 'lto-wrapper: fatal error',
+                'Internal Error at ']
 
 # configuration
 script_dirname = os.path.abspath(os.path.dirname(__file__))
@@ -50,12 +69,27 @@ oldest_active_branch = 10
 # Other locations should not by set up by a script consumer
 lock_path = os.path.join(script_dirname, '.gcc_build_binary.lock')
 lock = filelock.FileLock(lock_path)
+# FileLock is not guaranteed to exclude threads of the same process, parallel builds take both
+thread_lock = threading.Lock()
+# readers of the elfshaker store (extract) share the lock, writers (store, pack, gc) take it exclusively
+store_lock_path = os.path.join(script_dirname, '.gcc_bisect_store.lock')
 log_file = os.path.join(script_dirname, 'gcc-build.log')
+build_status_file = os.path.join(script_dirname, 'gcc-build-status.jsonl')
+results_file = os.path.join(script_dirname, 'gcc-bisect-results.jsonl')
+index_file = os.path.join(script_dirname, 'gcc-bisect-index.json')
 
 patches_folder = os.path.join(script_dirname, 'gcc-bisect-patches')
 patches = ['0001-Use-ucontext_t-not-struct-ucontext-in-linux-unwind.h.patch',
            'gnu-inline.patch', 'ubsan.patch', 'mallinfo.patch']
 
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 DESC = 'Bisect by prebuilt GCC binaries.'
 parser = argparse.ArgumentParser(description=DESC)
 parser.add_argument('command', nargs='?', metavar='command',
@@ -88,6 +122,13 @@ parser.add_argument('--success-exit-code', type=int, default=0,
 parser.add_argument('-u', '--unpack', help='Only unpack the revision and exit.')
 parser.add_argument('-t', '--timeout', type=float, help='Time out command after N seconds.')
 parser.add_argument('--soft-timeout', type=float, help='Finish a command and then apply timeout (in seconds).')
+parser.add_argument('-j', '--jobs', type=positive_int, default=1,
+                    help='Test N revisions in parallel (k-ary bisection), each in a separate extract location. '
+                    'With --build, build N revisions in parallel, each in a separate git worktree.')
+parser.add_argument('--no-results', action='store_true',
+                    help='Do not use (and do not record) stored test results.')
+parser.add_argument('--invalidate-results', action='store_true',
+                    help='Remove stored test results of the command before testing.')
 
 args = parser.parse_args()
 
@@ -109,6 +150,9 @@ git_location = config['Default']['git_location']
 elfshaker_data = config['Default']['elfshaker_data']
 extract_location = config['Default']['extract_location']
 elfshaker_bin = config['Default']['elfshaker_bin']
+# optional LRU cache of extracted revisions (one folder per revision)
+cache_location = config['Default'].get('cache_location')
+cache_size = config['Default'].getfloat('cache_size', 20) * 1024 ** 3
 
 repo = Repo(git_location)
 head = repo.commit('origin/master')
@@ -142,30 +186,470 @@ def strip_suffix(text, suffix):
     return text
 
 
-def log(revision_hash, message):
+@contextlib.contextmanager
+def store_lock(exclusive=False):
+    # every call opens its own file description, so the flock excludes threads of the process as well
+    fd = os.open(store_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+build_status = None
+# the store is first needed by parallel build workers
+build_status_lock = threading.Lock()
+
+
+def get_build_status():
+    global build_status
+    with build_status_lock:
+        if build_status is not None:
+            return build_status
+        import_log = not os.path.exists(build_status_file) and os.path.exists(log_file)
+        store = JsonlStore(build_status_file)
+        if import_log:
+            # seed the store from the human readable log
+            items = []
+            with open(log_file) as f:
+                for line in f:
+                    revision, _, message = line.strip().partition(':')
+                    status = 'OK' if message == 'OK' else 'failed'
+                    items.append((revision, {'status': status, 'error': message, 'duration': None,
+                                             'timestamp': None}))
+            store.put_many(items)
+        # publish the store only once it is seeded
+        build_status = store
+        return build_status
+
+
+def log(revision_hash, message, duration=None):
     with open(log_file, 'a+') as f:
         f.write(f'{revision_hash}:{message:.300}\n')
+    status = 'OK' if message == 'OK' else 'failed'
+    get_build_status().put(revision_hash, status=status, error=f'{message:.300}', duration=duration,
+                           timestamp=int(time.time()))
 
 
 def build_failed_for_revision(revision_hash):
-    if not os.path.exists(log_file):
-        return False
-
-    lines = [x.strip() for x in open(log_file).readlines()]
-    for line in lines:
-        i = line.find(':')
-        revision = line[:i]
-        if revision == revision_hash:
-            return True
+    return revision_hash in get_build_status()
+
+
+class JsonlStore:
+    """Append-only JSON lines file with an in-memory index, the last record of a key wins."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # truncated line of an interrupted write
+                        continue
+                    self.records[record['key']] = record
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def put(self, key, **values):
+        self.put_many([(key, values)])
+
+    def put_many(self, items):
+        """Append (key, values) pairs through a single open of the file."""
+        records = [{'key': key, **values} for key, values in items]
+        with self.lock:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    self.records[record['key']] = record
+                    f.write(json.dumps(record) + '\n')
+
+    def remove(self, predicate):
+        with self.lock:
+            self.records = {key: record for key, record in self.records.items() if not predicate(key)}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record) + '\n')
+            os.replace(tmp_path, self.path)
+
+
+def command_files():
+    """Yield existing files named by the command, e.g. the tested source file (but not the -o output)."""
+    try:
+        words = shlex.split(args.command)
+    except ValueError:
+        words = args.command.split()
+    for previous, word in zip([None] + words, words):
+        if previous != '-o' and os.path.isfile(word):
+            yield word
+
+
+def command_hash():
+    # everything that affects whether a test is considered successful
+    settings = [args.command, args.negate, args.ice, args.success_exit_code, args.timeout, args.soft_timeout,
+                ICE_MESSAGES, os.getcwd()]
+    digest = hashlib.sha256(json.dumps(settings).encode())
+    for path in command_files():
+        with open(path, 'rb') as f:
+            digest.update(path.encode() + b'\0' + hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+
+# answers of the --ask mode cannot be stored
+result_store = None
+if args.command and not args.no_results and not args.ask:
+    result_store = JsonlStore(results_file)
+    # computed once, the command itself can modify the files it names
+    result_hash = command_hash()
+    if args.invalidate_results:
+        suffix = ':' + result_hash
+        result_store.remove(lambda key: key.endswith(suffix))
+
+
+def elfshaker_signature():
+    # modification times of the folders that change when a snapshot is stored, packed or removed
+    signature = []
+    for folder in ('.', 'packs', 'packs/loose', 'loose'):
+        path = os.path.join(elfshaker_data, folder)
+        if os.path.exists(path):
+            signature.append(os.stat(path).st_mtime_ns)
+    return signature
+
+
+class RevisionIndex:
+    """Persistent index of revision metadata so that startup does not need to walk the git history.
+
+    The list of master revisions is updated incrementally from the last indexed tip,
+    merge bases are stored per release branch tip and output of 'elfshaker list'
+    is reused as long as the elfshaker data folder is unchanged.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {'version': self.VERSION, 'last_revision': last_revision, 'tip': None, 'latest': [],
+                     'branch_bases': {}, 'elfshaker': {}}
+        self.used_bases = set()
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION and data.get('last_revision') == last_revision:
+                    self.data = data
+            except json.JSONDecodeError:
+                pass
+
+    def latest(self):
+        """Return (hexsha, committed_date, committer_tz_offset) of master revisions, newest first."""
+        tip = self.data['tip']
+        if tip != head.hexsha:
+            if tip and repo.is_ancestor(tip, head.hexsha):
+                revisions = f'{tip}..{head.hexsha}'
+                known = self.data['latest']
+            else:
+                revisions = f'{last_revision}..{head.hexsha}'
+                known = []
+            new = [[c.hexsha, c.committed_date, c.committer_tz_offset]
+                   for c in repo.iter_commits(revisions, first_parent=True)]
+            self.data['latest'] = new + known
+            self.data['tip'] = head.hexsha
+            self.dirty = True
+        return self.data['latest']
+
+    def branch_base(self, branch_commit):
+        bases = self.data['branch_bases']
+        hexsha = branch_commit.hexsha
+        if hexsha not in bases:
+            bases[hexsha] = repo.merge_base(head, branch_commit)[0].hexsha
+            self.dirty = True
+        self.used_bases.add(hexsha)
+        return bases[hexsha]
+
+    def elfshaker_list(self, list_fn):
+        signature = elfshaker_signature()
+        if self.data['elfshaker'].get('signature') != signature:
+            self.data['elfshaker'] = {'signature': signature, 'list': list_fn()}
+            self.dirty = True
+        return self.data['elfshaker']['list']
+
+    def save(self):
+        bases = self.data['branch_bases']
+        if set(bases) != self.used_bases:
+            self.data['branch_bases'] = {k: v for k, v in bases.items() if k in self.used_bases}
+            self.dirty = True
+        if not self.dirty:
+            return
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def read_manifest(folder):
+    """Return list of (name, mode, symlink target) records, symlinks go first.
+
+    Snapshots created before the binary manifest have only METAFILE, executables
+    from it come with mode None (only the user executable bit is set).
+    """
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        with open(os.path.join(folder, METAFILE)) as f:
+            meta = json.load(f)
+        records = [(name, stat.S_IFLNK, target) for name, target in meta['symlinks'].items()]
+        return records + [(name, None, None) for name in meta['executables']]
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data.startswith(MANIFEST_MAGIC)
+    records = []
+    offset = len(MANIFEST_MAGIC)
+    while offset < len(data):
+        mode, name_length, target_length = MANIFEST_RECORD.unpack_from(data, offset)
+        offset += MANIFEST_RECORD.size
+        name = data[offset:offset + name_length].decode()
+        offset += name_length
+        target = data[offset:offset + target_length].decode() if stat.S_ISLNK(mode) else None
+        offset += target_length
+        records.append((name, mode, target))
+    return records
+
+
+def write_manifest(folder, records):
+    with open(os.path.join(folder, MANIFEST), 'wb') as f:
+        f.write(MANIFEST_MAGIC)
+        for name, mode, target in records:
+            name = name.encode()
+            target = target.encode() if target else b''
+            f.write(MANIFEST_RECORD.pack(mode, len(name), len(target)) + name + target)
+
+
+def apply_manifest(folder, records):
+    for name, mode, target in records:
+        path = os.path.join(folder, name)
+        if target is not None:
+            # symlinks are currently unsupported by elfshaker
+            os.symlink(target, path)
+        elif not os.path.exists(path):
+            # files listed in the manifest can be missing from the snapshot
+            continue
+        elif mode is not None:
+            os.chmod(path, stat.S_IMODE(mode))
+        else:
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def verify_manifest(folder, records):
+    for name, mode, target in records:
+        path = os.path.join(folder, name)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            if target is not None:
+                return False
+            # skipped by apply_manifest as well
+            continue
+        if target is not None:
+            if not stat.S_ISLNK(st.st_mode) or os.readlink(path) != target:
+                return False
+        elif mode is not None:
+            if stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode):
+                return False
+        elif not os.stat(path).st_mode & stat.S_IXUSR:
+            return False
+    return True
+
+
+def lazy_commit(hexsha):
+    # commit data are read from the object database only when needed
+    return Commit(repo, bytes.fromhex(hexsha))
+
+
+def folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            size += os.lstat(os.path.join(root, file)).st_size
+    return size
+
+
+class ExtractionCache:
+    """Size-bounded LRU cache of extracted revisions, one folder per hexsha.
+
+    Modification time of the STAMP file inside of an entry is the time of the last use,
+    the file content is the size of the entry in bytes. A test holds a shared flock of the STAMP
+    file (a lease) and entries that cannot be locked exclusively are not evicted.
+    """
+
+    STAMP = '.gcc-bisect-cache'
+
+    def __init__(self, location, size_limit):
+        self.location = location
+        self.size_limit = size_limit
+        os.makedirs(location, exist_ok=True)
+        self.lock = filelock.FileLock(os.path.join(location, '.lock'))
+        # FileLock is not guaranteed to exclude threads of the same process
+        self.thread_lock = threading.Lock()
+
+    def entry_path(self, hexsha):
+        return os.path.join(self.location, hexsha)
+
+    def stamp_path(self, hexsha):
+        return os.path.join(self.entry_path(hexsha), self.STAMP)
+
+    def lease(self, hexsha):
+        fd = os.open(self.stamp_path(hexsha), os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        return fd
+
+    def release(self, lease):
+        # closing the descriptor drops the flock
+        os.close(lease)
+
+    def lookup(self, hexsha):
+        stamp = self.stamp_path(hexsha)
+        if os.path.exists(stamp):
+            os.utime(stamp)
+            return self.entry_path(hexsha)
+        return None
+
+    def get(self, revision):
+        """Return path of the extracted revision and a lease that has to be released after use."""
+        hexsha = revision.commit.hexsha
+        with self.thread_lock, self.lock:
+            path = self.lookup(hexsha)
+            if path:
+                return (path, self.lease(hexsha))
+
+        # extract outside of the lock so that parallel workers do not wait for each other
+        tmp_path = self.entry_path(f'{hexsha}.tmp-{os.getpid()}-{threading.get_ident()}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        revision.extract(tmp_path)
+        size = folder_size(tmp_path)
+
+        with self.thread_lock, self.lock:
+            path = self.entry_path(hexsha)
+            if self.lookup(hexsha):
+                shutil.rmtree(tmp_path)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp_path, path)
+                with open(self.stamp_path(hexsha), 'w') as f:
+                    f.write(str(size))
+            lease = self.lease(hexsha)
+            self.evict()
+            return (path, lease)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.location):
+            stamp = self.stamp_path(name)
+            if os.path.exists(stamp):
+                with open(stamp) as f:
+                    entries.append((os.stat(stamp).st_mtime, int(f.read()), name))
+            elif '.tmp-' in name:
+                # extraction in progress, remove it only if the owning process is gone
+                pid = int(name.split('.tmp-')[1].split('-')[0])
+                if not psutil.pid_exists(pid):
+                    shutil.rmtree(self.entry_path(name), ignore_errors=True)
+            elif os.path.isdir(self.entry_path(name)):
+                # leftover of an interrupted extraction
+                shutil.rmtree(self.entry_path(name), ignore_errors=True)
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        # never remove the most recently used entry
+        for _, size, hexsha in entries[:-1]:
+            if total <= self.size_limit:
+                break
+            try:
+                fd = os.open(self.stamp_path(hexsha), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # a test is running from the entry
+                os.close(fd)
+                continue
+            shutil.rmtree(self.entry_path(hexsha), ignore_errors=True)
+            os.close(fd)
+            total -= size
+            if args.verbose:
+                flush_print(f'Evicting {hexsha} from extraction cache')
+
+
+cache = ExtractionCache(cache_location, cache_size) if cache_location else None
+
+
+def slot_location(slot):
+    # the first slot shares extract location with --build and --unpack
+    return extract_location if slot == 0 else f'{extract_location}-{slot}'
 
-    return False
 
+def slot_lock(slot):
+    return lock if slot == 0 else filelock.FileLock(slot_location(slot) + '.lock')
 
-def run_cmd(command, strict=False):
+
+worktree_lock = threading.Lock()
+
+
+def slot_source(slot):
+    # the first slot builds in the main checkout, others in git worktrees
+    if slot == 0:
+        return git_location
+    path = f'{git_location}-worktree-{slot}'
+    with worktree_lock:
+        if not os.path.exists(path):
+            repo.git.worktree('add', '--detach', path, 'origin/master')
+    return path
+
+
+def slot_build_folder(slot):
+    return '/dev/shm/gcc-bisect-tmp' if slot == 0 else f'/dev/shm/gcc-bisect-tmp-{slot}'
+
+
+def slot_install_location(slot):
+    return f'{extract_location}-install-{slot}'
+
+
+def map_slots(fn, items, jobs):
+    """Call fn(item, slot) in a pool of workers where each worker owns a unique slot number.
+
+    Results are yielded in the order of items.
+    """
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    def call(item):
+        slot = slots.get()
+        try:
+            return fn(item, slot)
+        finally:
+            slots.put(slot)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(call, items)
+
+
+def run_cmd(command, strict=False, cwd=None, env=None):
     if isinstance(command, list):
         command = ' '.join(command)
     flush_print('Running: %s' % command)
-    r = subprocess.run(command, shell=True, capture_output=True)
+    r = subprocess.run(command, shell=True, capture_output=True, cwd=cwd, env=env)
     if r.returncode == args.success_exit_code:
         return (True, None)
     else:
@@ -182,13 +666,17 @@ def run_cmd(command, strict=False):
 
 
 class GitRevision:
-    def __init__(self, commit):
+    def __init__(self, commit, timestamp=None):
         self.commit = commit
+        self.timestamp = timestamp
         self.has_binary = False
         self.in_pack = False
+        self.location = extract_location
+        self.lease = None
 
     def timestamp_str(self):
-        return self.commit.committed_datetime.strftime('%d %b %Y %H:%M')
+        timestamp = self.timestamp if self.timestamp else self.commit.committed_datetime
+        return timestamp.strftime('%d %b %Y %H:%M')
 
     def __str__(self):
         return self.commit.hexsha + ':' + self.timestamp_str()
@@ -214,80 +702,111 @@ class GitRevision:
     def patch_name(self):
         return self.commit.hexsha + '.patch'
 
-    def run(self, describe):
-        with lock:
-            extraction_time = self.decompress()
-            start = time.monotonic()
+    def result_key(self):
+        return f'{self.commit.hexsha}:{result_hash}'
 
-            my_env = os.environ.copy()
-            my_env['PATH'] = (os.path.join(self.get_install_path(), 'bin')
-                              + ':' + my_env['PATH'])
-            ld_library_path = my_env['LD_LIBRARY_PATH'] if 'LD_LIBRARY_PATH' in my_env else ''
-            my_env['LD_LIBRARY_PATH'] = os.path.join(self.get_install_path(), 'lib64') + ':' + ld_library_path
+    def run(self, describe, slot=0):
+        record = result_store.get(self.result_key()) if result_store else None
+        if record:
+            stdout = record['output']
+            details = '[stored result]'
+        else:
+            if cache:
+                # cached entries are never modified, the lease only protects the entry from eviction
+                try:
+                    extraction_time = self.decompress(slot)
+                    stdout, record = self.execute()
+                finally:
+                    self.release()
+            else:
+                with slot_lock(slot):
+                    extraction_time = self.decompress(slot)
+                    stdout, record = self.execute()
+            if result_store:
+                result_store.put(self.result_key(), **record)
+            details = f'[extraction: {extraction_time:.1f} s]' if args.verbose else ''
+
+        success = record['success']
+        text = f'{colored("OK", "green")}' if success else f'{colored("FAILED", "red")}'
+        text += f' ({record["returncode"]})'
+        report = f'  {self.description(describe)}: {details}[took: {record["duration"]:3.2f} s] result: {text}\n'
+        if not args.silent:
+            report += stdout
+        return (success, stdout, report)
+
+    def execute(self):
+        start = time.monotonic()
 
-            try:
-                r = subprocess.run(args.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                   env=my_env, encoding='utf8', timeout=args.timeout)
-                returncode = r.returncode
-                stdout = r.stdout
-
-            except subprocess.TimeoutExpired:
-                returncode = 124
-                stdout = ''
-            finally:
-                # handle ICE
-                success = returncode == args.success_exit_code
-                if success and args.ask:
-                    if not args.silent:
-                        flush_print(stdout, end='')
-                    success = input('Retcode: ') == '0'
-                elif args.ice:
-                    messages = ['internal compiler error', 'Fatal Error', 'Internal compiler error',
-                                'Please submit a full bug report', 'lto-wrapper: fatal error',
-                                'Internal Error at ']
-                    success = any(m for m in messages if m in stdout)
-
-                seconds = time.monotonic() - start
-                if args.soft_timeout and success:
-                    success = seconds <= args.soft_timeout
-
-                if args.negate:
-                    success = not success
-
-                text = f'{colored("OK", "green")}' if success else f'{colored("FAILED", "red")}'
-                text += f' ({returncode})'
-                details = f'[extraction: {extraction_time:.1f} s]' if args.verbose else ''
-                flush_print(f'  {self.description(describe)}: {details}[took: {seconds:3.2f} s] result: {text}')
+        my_env = os.environ.copy()
+        my_env['PATH'] = (os.path.join(self.get_install_path(), 'bin')
+                          + ':' + my_env['PATH'])
+        ld_library_path = my_env['LD_LIBRARY_PATH'] if 'LD_LIBRARY_PATH' in my_env else ''
+        my_env['LD_LIBRARY_PATH'] = os.path.join(self.get_install_path(), 'lib64') + ':' + ld_library_path
+
+        try:
+            r = subprocess.run(args.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               env=my_env, encoding='utf8', timeout=args.timeout)
+            returncode = r.returncode
+            stdout = r.stdout
+
+        except subprocess.TimeoutExpired:
+            returncode = 124
+            stdout = ''
+        finally:
+            # handle ICE
+            success = returncode == args.success_exit_code
+            if success and args.ask:
                 if not args.silent:
                     flush_print(stdout, end='')
+                success = input('Retcode: ') == '0'
+            elif args.ice:
+                success = any(m for m in ICE_MESSAGES if m in stdout)
 
-            return (success, stdout)
+            seconds = time.monotonic() - start
+            if args.soft_timeout and success:
+                success = seconds <= args.soft_timeout
 
-    def test(self, describe=False):
+            if args.negate:
+                success = not success
+
+        record = {'success': success, 'returncode': returncode, 'duration': seconds,
+                  'output': stdout[:RESULT_OUTPUT_LIMIT]}
+        return (stdout, record)
+
+    def evaluate(self, describe=False, slot=0):
         if not self.has_binary:
-            flush_print('  %s: missing binary' % (self.description()))
-            return (False, None)
+            return (False, None, '  %s: missing binary\n' % (self.description()))
         else:
-            return self.run(describe)
+            return self.run(describe, slot)
 
-    def get_install_path(self):
-        return os.path.join(extract_location, 'usr', 'local')
-
-    def install(self, start):
-        with lock:
-            if os.path.exists(extract_location):
-                shutil.rmtree(extract_location)
-            run_cmd('make install DESTDIR=' + extract_location)
-            with (open(os.path.join(extract_location, 'git-revision.txt'), 'w+')) as note:
-                note.write(self.commit.hexsha)
-            self.compress()
-            took = int(time.monotonic() - start)
-            build_times.append(took)
-            flush_print(f'Build has taken: {str(took)}, avg: {str(sum(build_times) // len(build_times))}')
-            log(self.commit.hexsha, 'OK')
+    def test(self, describe=False):
+        success, stdout, report = self.evaluate(describe)
+        flush_print(report, end='')
+        return (success, stdout)
 
-    def build(self):
-        build_command = f'nice make -j{CPU_COUNT} CFLAGS="-O2 -g0" CXXFLAGS="-O2 -g0"'
+    def get_install_path(self):
+        return os.path.join(self.location, 'usr', 'local')
+
+    def install(self, start, slot, build_folder):
+        install_location = slot_install_location(slot)
+        if os.path.exists(install_location):
+            shutil.rmtree(install_location)
+        run_cmd('make install DESTDIR=' + install_location, cwd=build_folder)
+        with (open(os.path.join(install_location, 'git-revision.txt'), 'w+')) as note:
+            note.write(self.commit.hexsha)
+        self.compress(install_location)
+        shutil.rmtree(install_location)
+        took = int(time.monotonic() - start)
+        build_times.append(took)
+        flush_print(f'Build has taken: {str(took)}, avg: {str(sum(build_times) // len(build_times))}')
+        log(self.commit.hexsha, 'OK', took)
+
+    def build(self, slot=0, env=None):
+        if env:
+            # parallel builds share a jobserver
+            build_command = 'nice make CFLAGS="-O2 -g0" CXXFLAGS="-O2 -g0"'
+        else:
+            build_command = f'nice make -j{CPU_COUNT} CFLAGS="-O2 -g0" CXXFLAGS="-O2 -g0"'
         if build_failed_for_revision(self.commit.hexsha):
             if args.verbose:
                 flush_print('Revision %s already failed' % (str(self)))
@@ -295,23 +814,23 @@ class GitRevision:
         else:
             flush_print('Building %s' % (str(self)))
             start = time.monotonic()
-            tmp_folder = '/dev/shm/gcc-bisect-tmp'
+            source = slot_source(slot)
+            tmp_folder = slot_build_folder(slot)
 
-            if os.path.exists(tmp_folder):
-                # try to reuse current build folder, should be very fast then
-                repo.git.checkout(self.commit, force=True)
+            # a new worktree is at origin/master, always build the right sources
+            Repo(source).git.checkout(self.commit.hexsha, force=True)
 
-                os.chdir(git_location)
-                # apply all patches
-                for p in patches:
-                    r = subprocess.run('patch -p1 < ' + os.path.join(patches_folder, p),
-                                       shell=True, capture_output=True, encoding='utf8')
-                    flush_print('applying patch %s with result: %d' % (p, r.returncode))
+            # apply all patches
+            for p in patches:
+                r = subprocess.run('patch -p1 < ' + os.path.join(patches_folder, p),
+                                   shell=True, capture_output=True, encoding='utf8', cwd=source)
+                flush_print('applying patch %s with result: %d' % (p, r.returncode))
 
-                os.chdir(tmp_folder)
-                r = run_cmd(build_command)
+            if os.path.exists(tmp_folder):
+                # try to reuse current build folder, should be very fast then
+                r = run_cmd(build_command, cwd=tmp_folder, env=env)
                 if r[0]:
-                    self.install(start)
+                    self.install(start, slot, tmp_folder)
                     return True
 
             flush_print('Cannot build, clean-up and start again with clean build folder')
@@ -319,80 +838,91 @@ class GitRevision:
                 shutil.rmtree(tmp_folder)
             if not os.path.exists(tmp_folder):
                 os.mkdir(tmp_folder)
-            os.chdir(tmp_folder)
-            cmd = [os.path.join(git_location, 'configure'), '--disable-bootstrap', '--enable-checking=yes',
+            cmd = [os.path.join(source, 'configure'), '--disable-bootstrap', '--enable-checking=yes',
                    '--disable-libsanitizer', '--enable-languages=c,c++,fortran',
                    '--without-isl', '--disable-cet',
                    '--disable-libstdcxx-pch', '--disable-static']
-            run_cmd(cmd, True)
-            run_cmd('echo "MAKEINFO = :" >> Makefile')
-            r = run_cmd(build_command)
+            run_cmd(cmd, True, cwd=tmp_folder)
+            run_cmd('echo "MAKEINFO = :" >> Makefile', cwd=tmp_folder)
+            r = run_cmd(build_command, cwd=tmp_folder, env=env)
             if r[0]:
-                self.install(start)
+                self.install(start, slot, tmp_folder)
                 return True
             else:
-                log(self.commit.hexsha, r[1])
+                log(self.commit.hexsha, r[1], int(time.monotonic() - start))
                 flush_print('GCC build is not going to be installed')
 
             return False
 
-    def strip(self):
-        if os.path.exists(extract_location):
-            run_cmd('find %s -exec strip --strip-debug {} \\;' % extract_location)
+    def strip(self, folder):
+        if os.path.exists(folder):
+            run_cmd('find %s -exec strip --strip-debug {} \\;' % folder)
 
-    def collect_metainfo(self):
-        symlinks = {}
+    def collect_metainfo(self, folder):
+        symlinks = []
         executables = []
 
-        for root, _, files in os.walk('.'):
+        for root, _, files in os.walk(folder):
             for file in files:
-                path = Path(root, file)
-                if path.is_symlink():
-                    symlinks[str(path)] = str(path.readlink())
-                if path.stat().st_mode & stat.S_IXUSR:
-                    executables.append(str(path))
-
-        meta = {'symlinks': symlinks, 'executables': sorted(executables)}
-        with open(METAFILE, 'w') as f:
-            json.dump(meta, f, indent=2)
-
-    def compress(self):
-        self.strip()
-        current = os.getcwd()
-        os.chdir(extract_location)
-        self.collect_metainfo()
+                path = os.path.join(root, file)
+                # paths are stored relative to the folder, e.g. ./usr/local/bin/gcc
+                name = os.path.join('.', os.path.relpath(path, folder))
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    symlinks.append((name, st.st_mode, os.readlink(path)))
+                elif st.st_mode & stat.S_IXUSR:
+                    executables.append((name, st.st_mode, None))
+
+        write_manifest(folder, sorted(symlinks) + sorted(executables))
+
+    def compress(self, folder):
+        self.strip(folder)
+        self.collect_metainfo(folder)
         cmd = f'{elfshaker_bin} --data-dir {elfshaker_data} store {self.commit}'
-        subprocess.check_output(cmd, shell=True)
-        os.chdir(current)
+        # only the elfshaker store is serialized between parallel builds
+        with thread_lock, lock, store_lock(exclusive=True):
+            subprocess.check_output(cmd, shell=True, cwd=folder)
 
-    def decompress(self):
+    def extract(self, destination):
+        os.makedirs(destination)
+        cmd = f'{elfshaker_bin} --data-dir {elfshaker_data} extract {self.commit} --verify --reset'
+        # slot locks protect only the destination, not the store
+        with store_lock():
+            subprocess.check_output(cmd, stderr=subprocess.DEVNULL, shell=True, cwd=destination)
+        apply_manifest(destination, read_manifest(destination))
+        with open(os.path.join(destination, EXTRACTED_STAMP), 'w') as f:
+            f.write(self.commit.hexsha)
+
+    def is_extracted(self, destination):
+        """Fast path: the destination already contains this revision with correct metadata."""
+        try:
+            with open(os.path.join(destination, EXTRACTED_STAMP)) as f:
+                if f.read() != self.commit.hexsha:
+                    return False
+            return verify_manifest(destination, read_manifest(destination))
+        except (OSError, ValueError, AssertionError, struct.error):
+            return False
+
+    def decompress(self, slot=0):
         if not self.has_binary:
             return None
 
         start = time.monotonic()
-        shutil.rmtree(extract_location, ignore_errors=True)
-        os.makedirs(extract_location)
-        current = os.getcwd()
-        os.chdir(extract_location)
-        cmd = f'{elfshaker_bin} --data-dir {elfshaker_data} extract {self.commit} --verify --reset'
-        subprocess.check_output(cmd, stderr=subprocess.DEVNULL, shell=True)
-
-        with open(METAFILE) as fp:
-            meta = json.load(fp)
-
-            # First create symlinks that are currently unsupported by elfshaker
-            for symlink, target in meta['symlinks'].items():
-                Path(symlink).symlink_to(target)
-
-            # Set executable flag
-            for execfile in meta['executables']:
-                p = Path(execfile)
-                if p.exists():
-                    p.chmod(p.stat().st_mode | stat.S_IXUSR)
-
-        os.chdir(current)
+        if cache:
+            self.release()
+            self.location, self.lease = cache.get(self)
+        else:
+            self.location = slot_location(slot)
+            if not self.is_extracted(self.location):
+                shutil.rmtree(self.location, ignore_errors=True)
+                self.extract(self.location)
         return time.monotonic() - start
 
+    def release(self):
+        if self.lease is not None:
+            cache.release(self.lease)
+            self.lease = None
+
     def print_status(self):
         status = colored('OK', 'green') if self.has_binary else colored('missing binary', 'yellow')
         flush_print(f'{self.description()}: {status}')
@@ -451,6 +981,7 @@ class GitRepository:
         self.branches = []
         self.branch_bases = []
         self.latest = []
+        self.index = RevisionIndex(index_file)
 
         if args.fetch:
             attempts = 10
@@ -468,6 +999,7 @@ class GitRepository:
 
         self.all = [self.releases, self.branch_bases, self.branches, self.latest]
         self.initialize_binaries()
+        self.index.save()
 
     def pull(self):
         flush_print('Pulling origin repository')
@@ -503,15 +1035,15 @@ class GitRepository:
             branch_commit = repo.commit(b.name)
             if name and int(name) >= oldest_active_branch:
                 self.branches.append(Branch(name, branch_commit))
-            base = repo.merge_base(head, branch_commit)[0]
             # Align this with last_revision
             if int(name) >= 6:
+                base = lazy_commit(self.index.branch_base(branch_commit))
                 self.branch_bases.append(Release(name + '-base', base))
         self.branches.append(Branch(self.get_master_branch(), head))
 
     def parse_latest_revisions(self):
-        for c in repo.iter_commits(last_revision + '..origin/master', first_parent=True):
-            self.latest.append(GitRevision(c))
+        for hexsha, committed_date, tz_offset in self.index.latest():
+            self.latest.append(GitRevision(lazy_commit(hexsha), from_timestamp(committed_date, tz_offset)))
 
     @staticmethod
     def get_patch_name_tokens(file):
@@ -549,7 +1081,7 @@ class GitRepository:
                                 encoding='utf8', shell=True)
 
     def initialize_binaries(self):
-        existing = {t[1] for t in self.elfshaker_list()}
+        existing = {t[1] for t in self.index.elfshaker_list(self.elfshaker_list)}
         for source in self.all:
             for r in source:
                 if r.commit.hexsha in existing:
@@ -561,21 +1093,46 @@ class GitRepository:
         return [line.split(':') for line in lines]
 
     def build(self):
-        # First build branch tips and releases (skip last which is master branch)
-        # Pack each revision individually.
-        for r in self.releases[:-1] + self.branches[:-1]:
-            if not r.has_binary and r.build():
-                with lock:
+        if args.jobs == 1:
+            self.build_revisions()
+            return
+
+        # K parallel builds share CPU_COUNT jobs through a jobserver (see jobserver.py),
+        # each top-level make owns one implicit job slot
+        with tempfile.TemporaryDirectory() as folder:
+            fifopath = os.path.join(folder, 'jobserver')
+            os.mkfifo(fifopath)
+            writefd = os.open(fifopath, os.O_RDWR)
+            tokens = max(CPU_COUNT - args.jobs, 0)
+            written = os.write(writefd, b'+' * tokens)
+            assert written == tokens
+            env = os.environ.copy()
+            env['MAKEFLAGS'] = f'--jobserver-auth=fifo:{fifopath}'
+            try:
+                self.build_revisions(env)
+            finally:
+                os.close(writefd)
+
+    def build_revisions(self, env=None):
+        def build_tip(r, slot):
+            if r.build(slot, env):
+                with thread_lock, lock, store_lock(exclusive=True):
                     self.pack(f'pack-{r.commit.hexsha}', [r.commit.hexsha])
                     self.cleanup()
 
+        # First build branch tips and releases (skip last which is master branch)
+        # Pack each revision individually.
+        tips = [r for r in self.releases[:-1] + self.branches[:-1] if not r.has_binary]
+        for _ in map_slots(build_tip, tips, args.jobs):
+            pass
+
         # Build all latest revisions in reverse order and pack
         # if we have enough snapshots.
-        for r in reversed(self.latest):
-            if not r.has_binary:
-                r.build()
+        missing = [r for r in reversed(self.latest) if not r.has_binary]
+        for _ in map_slots(lambda r, slot: r.build(slot, env), missing, args.jobs):
+            pass
 
-        with lock:
+        with lock, store_lock(exclusive=True):
             tuples = self.elfshaker_list()
             loose = {line[1] for line in tuples if line[0].startswith('loose/')}
 
@@ -593,6 +1150,35 @@ class GitRepository:
 
             # Back-up gcc-build.log file to elfshaker folder
             shutil.copyfile(log_file, Path(elfshaker_data, '../build-log-backup.txt'))
+            if os.path.exists(build_status_file):
+                shutil.copyfile(build_status_file, Path(elfshaker_data, '../build-status-backup.jsonl'))
+
+    def test_revisions(self, revisions, headers=None):
+        """Test revisions in parallel and print results in the original order.
+
+        Headers are printed before the result of the revision with the given index.
+        """
+        if headers is None:
+            headers = {}
+        jobs = 1 if args.ask else args.jobs
+        results = []
+        # a revision listed twice (e.g. -s and -e name the same one) is tested only once,
+        # GitRevision keeps its extract location and must not be evaluated by two workers
+        unique = list({id(r): r for r in revisions}.values())
+        evaluated = map_slots(lambda r, slot: r.evaluate(slot=slot), unique, jobs)
+        outcomes = {}
+        for i, r in enumerate(revisions):
+            if id(r) not in outcomes:
+                outcomes[id(r)] = next(evaluated)
+            success, stdout, report = outcomes[id(r)]
+            if i in headers:
+                flush_print(headers[i])
+            flush_print(report, end='')
+            results.append((success, stdout))
+        for i in sorted(headers):
+            if i >= len(revisions):
+                flush_print(headers[i])
+        return results
 
     def find_commit(self, name, candidates):
         if 'base' in name:
@@ -610,23 +1196,22 @@ class GitRepository:
 
         self.failing_branches = None
         if not args.only_latest:
-            flush_print(colored('Releases', title_color))
-            self.failing_branches = []
-            for r in self.releases:
-                r.test()
+            # all the revisions are independent, test them at once
+            revisions = self.releases + self.branches + self.branch_bases
+            headers = {0: colored('Releases', title_color),
+                       len(self.releases): colored('\nActive branches', title_color),
+                       len(self.releases) + len(self.branches): colored('\nActive branch bases', title_color)}
+            results = self.test_revisions(revisions, headers)
 
-            flush_print(colored('\nActive branches', title_color))
-            for r in self.branches:
-                report = not r.test()[0]
+            self.failing_branches = []
+            branch_results = results[len(self.releases):len(self.releases) + len(self.branches)]
+            for r, result in zip(self.branches, branch_results):
+                report = not result[0]
                 if args.ice:
                     report = not report
                 if report:
                     self.failing_branches.append(r.name)
 
-            flush_print(colored('\nActive branch bases', title_color))
-            for r in self.branch_bases:
-                r.test()
-
         flush_print(colored('\nBisecting latest revisions', title_color))
         candidates = list(filter(lambda x: x.has_binary, self.latest))
 
@@ -640,8 +1225,7 @@ class GitRepository:
             r = self.find_commit(args.bisect_end, candidates)
             candidates = candidates[:candidates.index(r)+1]
 
-        first = candidates[0].test()[0]
-        last = candidates[-1].test()[0]
+        first, last = [r[0] for r in self.test_revisions([candidates[0], candidates[-1]])]
 
         if first != last:
             self.bisect_recursive(candidates, first, last)
@@ -675,20 +1259,24 @@ class GitRepository:
                 flush_print(colored('Revisions in between: %d' % length, 'red', attrs=['bold']))
             self.print_bugzilla_title(output[1], candidates[0])
         else:
-            steps = math.ceil(math.log2(len(candidates))) - 1
+            # split the range into parts by testing (parts - 1) evenly spaced revisions
+            parts = min(args.jobs + 1, len(candidates) - 1)
+            steps = math.ceil(math.log2(len(candidates)) / math.log2(parts)) - 1
             flush_print('  bisecting: %d revisions (~%d steps)' % (len(candidates), steps))
             assert r1 != r2
-            index = int(len(candidates) / 2)
-            middle = candidates[index].test()[0]
-            if r1 == middle:
-                self.bisect_recursive(candidates[index:], middle, r2)
-            else:
-                assert middle == r2
-                self.bisect_recursive(candidates[:index+1], r1, middle)
+            indices = [i * len(candidates) // parts for i in range(1, parts)]
+            results = [r[0] for r in self.test_revisions([candidates[i] for i in indices])]
+
+            # narrow to the first sub-interval where the result flips
+            points = [(0, r1)] + list(zip(indices, results)) + [(len(candidates) - 1, r2)]
+            for (i1, v1), (i2, v2) in zip(points, points[1:]):
+                if v1 != v2:
+                    self.bisect_recursive(candidates[i1:i2 + 1], v1, v2)
+                    return
 
     def gc(self):
         candidates = {r.commit.hexsha for r in self.latest + self.branches + self.releases}
-        with lock:
+        with lock, store_lock(exclusive=True):
             example = 'pack-0c1af5b6fde830146e5003b018ebabd2095533f4'
             single_packs = {t[0][5:] for t in self.elfshaker_list() if len(t[0]) == len(example)}
             todelete = single_packs - candidates
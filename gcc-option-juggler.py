@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import pickle
 import subprocess
 import random
 import sys
@@ -11,7 +13,10 @@ import traceback
 import os
 import tempfile
 import logging
+import resource
 import shutil
+import sqlite3
+import uuid
 
 from itertools import *
 from threading import Lock
@@ -23,6 +28,19 @@ from multiprocessing import Pool
 
 GCC_DIR = '/home/marxin/Programming/gcc'
 LLVM_DIR = '/home/marxin/Programming/llvm-project'
+CACHE_DIR = os.path.expanduser('~/.cache/gcc-option-juggler')
+
+# share of tests that choose options and source file uniformly
+EXPLORATION = 0.2
+# number of tests an unknown option or source file is assumed to have the average new ICE rate for
+PRIOR_RUNS = 50
+# a hit of an already known ICE costs as much as this number of tests without an ICE on top of the test itself
+KNOWN_ICE_PENALTY = 1
+WEIGHTS_REFRESH = 60
+# a claim of an unreduced ICE older than this (in seconds) can be taken over by another worker
+CLAIM_TIMEOUT = 3600
+# identifies claims of this run, pids of workers are reused across runs
+RUN_ID = uuid.uuid4().hex
 
 known_bugs = {'clear_padding_type, at gimple-fold.c': 'PRxxx'}
 
@@ -39,8 +57,13 @@ parser.add_argument('-l', '--logging', action = 'store_true', help = 'Log error
 parser.add_argument('-f', '--filter', action = 'store_true', help = 'First filter valid source files')
 parser.add_argument('-m', '--maxparam', help = 'Maximum param value')
 parser.add_argument('-t', '--target', default = 'x86_64', help = 'Default target', choices = ['x86_64', 'ppc64', 'ppc64le', 's390x', 'aarch64', 'arm', 'riscv64'])
+parser.add_argument('--cache-dir', default = CACHE_DIR, help = f'Folder with the database of found ICEs and cached options (default: {CACHE_DIR})')
 args = parser.parse_args()
 
+os.makedirs(args.cache_dir, exist_ok = True)
+ice_database = os.path.join(args.cache_dir, 'ices.db')
+
+# (level, option) -> validity
 option_validity_cache = {}
 
 FNULL = open(os.devnull, 'w')
@@ -126,9 +149,6 @@ source_files = list(filter(lambda x: not '/rtl/' in x, source_files))
 # filter out different target tests
 source_files = list(filter(is_valid_test_case_for_target, source_files))
 
-ice_cache = set()
-ice_locations = set()
-
 source_files = set(source_files)
 
 print('Found %d files.' % len(source_files))
@@ -144,15 +164,42 @@ def output_for_command(command):
     return lines
 
 def check_option(level, option):
-    if option in option_validity_cache:
-        return option_validity_cache[option]
+    if (level, option) in option_validity_cache:
+        return option_validity_cache[(level, option)]
 
     cmd = f'{get_compiler()} -c -c {empty} {level} {option}'
     r = subprocess.run(cmd, shell = True, capture_output=True)
     result = r.returncode == 0
-    option_validity_cache[option] = result
+    option_validity_cache[(level, option)] = result
     return result
 
+def compiler_identity():
+    """
+    Return a key of the compiler binaries (driver and cc1) and of the arguments that
+    influence the option model, a rebuilt compiler invalidates the cached options.
+    """
+    parts = [args.target, str(args.maxparam)]
+    cc1 = subprocess.check_output([get_compiler(), '-print-prog-name=cc1'], encoding = 'utf8').strip()
+    for program in (shutil.which(get_compiler()), shutil.which(cc1)):
+        if program:
+            st = os.stat(program)
+            parts += [os.path.realpath(program), str(st.st_mtime_ns), str(st.st_size)]
+    return hashlib.sha1(' '.join(parts).encode()).hexdigest()[:16]
+
+def load_cache(filename, default):
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        return default
+
+def save_cache(filename, data):
+    # write atomically, a killed run must not leave a truncated cache
+    tmp = f'{filename}.tmp-{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        pickle.dump(data, f)
+    os.replace(tmp, filename)
+
 def find_ice(stderr):
     lines = stderr.split('\n')
     subject = None
@@ -191,6 +238,157 @@ def find_ice(stderr):
 
     return None
 
+def normalize_backtrace(bt):
+    # addresses and line numbers differ in between builds of the same bug
+    bt = re.sub(r'0x[0-9a-f]+', '0x0', bt)
+    bt = re.sub(r'(\.\w+):[0-9]+(:[0-9]+)?', r'\1', bt)
+    return ' '.join(bt.split())
+
+class IceDatabase:
+    """
+    ICEs found by all workers (and previous runs) in a SQLite file, keyed by normalized backtrace.
+
+    A worker has to claim a new signature before it reduces it, so every bug is reduced once.
+    A claim of a worker that died, of a previous run or older than CLAIM_TIMEOUT is taken over.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = None
+        self.connection = None
+
+    def connect(self):
+        # a connection cannot be shared with forked workers
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.connection = sqlite3.connect(self.filename, timeout = 600, isolation_level = None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS ices (signature TEXT PRIMARY KEY, location TEXT, '
+                                    'backtrace TEXT, command TEXT, reduced TEXT, claimed_by INTEGER, found REAL, hits INTEGER, '
+                                    'run_id TEXT, claimed REAL)')
+            # databases of older versions lack the claim details
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(ices)')]
+            for column, kind in (('run_id', 'TEXT'), ('claimed', 'REAL')):
+                if column not in columns:
+                    self.connection.execute(f'ALTER TABLE ices ADD COLUMN {column} {kind}')
+            # outcomes of the tests per option and per source file, used by Scheduler
+            for table in ('option_stats', 'source_stats'):
+                self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (name TEXT PRIMARY KEY, runs INTEGER, '
+                                        'ices INTEGER, new_ices INTEGER, timeouts INTEGER, errors INTEGER, cpu_time REAL)')
+        return self.connection
+
+    def claim(self, ice, cmd):
+        db = self.connect()
+        signature = normalize_backtrace(ice[1])
+        now = time()
+        if db.execute('INSERT OR IGNORE INTO ices VALUES (?, ?, ?, ?, NULL, ?, ?, 1, ?, ?)',
+                      (signature, ice[0], ice[1], cmd, os.getpid(), now, RUN_ID, now)).rowcount:
+            return signature
+
+        db.execute('UPDATE ices SET hits = hits + 1 WHERE signature = ?', (signature,))
+        row = db.execute('SELECT claimed_by, reduced, run_id, claimed FROM ices WHERE signature = ?', (signature,)).fetchone()
+        claimed_by, reduced, run_id, claimed = row
+        if reduced != None or (claimed_by == os.getpid() and run_id == RUN_ID):
+            return None
+        if run_id == RUN_ID and pid_exists(claimed_by) and claimed != None and now - claimed < CLAIM_TIMEOUT:
+            return None
+        # only one of the workers can win the take over
+        if db.execute('UPDATE ices SET claimed_by = ?, command = ?, run_id = ?, claimed = ? '
+                      'WHERE signature = ? AND claimed_by IS ? AND run_id IS ? AND claimed IS ?',
+                      (os.getpid(), cmd, RUN_ID, now, signature, claimed_by, run_id, claimed)).rowcount:
+            return signature
+        return None
+
+    def reduced(self, signature, reduced_command):
+        self.connect().execute('UPDATE ices SET reduced = ? WHERE signature = ?', (reduced_command, signature))
+
+    def count(self):
+        return self.connect().execute('SELECT COUNT(*) FROM ices').fetchone()[0]
+
+    def found_since(self, timestamp):
+        return self.connect().execute('SELECT location, reduced, hits FROM ices WHERE found >= ? ORDER BY found',
+                                      (timestamp,)).fetchall()
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+ices = IceDatabase(ice_database)
+
+class Scheduler:
+    """
+    Choose options and source files biased by the outcomes of the previous tests of all workers and runs.
+
+    The weight is the smoothed rate of new ICE signatures relative to the average one, hits of already known
+    ICEs are penalized; for source files it is also scaled down by the share of tests that ended with an error
+    or a timeout.
+    """
+    def __init__(self):
+        self.refreshed = 0
+        self.option_weights = {}
+        self.source_weights = {}
+        self.sources = None
+
+    def refresh(self):
+        if time() - self.refreshed < WEIGHTS_REFRESH:
+            return
+        self.refreshed = time()
+        db = ices.connect()
+        runs, found = db.execute('SELECT SUM(runs), SUM(new_ices) FROM source_stats').fetchone()
+        new_ice_rate = found / runs if runs and found else 0
+
+        def relative_ice_rate(runs, found, new_ices):
+            # new ICEs in units of the average rate, known ICEs only make the tests more expensive
+            expected = new_ices / new_ice_rate if new_ice_rate else 0
+            known = found - new_ices
+            return (expected + PRIOR_RUNS) / (runs + KNOWN_ICE_PENALTY * known + PRIOR_RUNS)
+
+        self.option_weights = {}
+        for name, runs, found, new_ices, timeouts, errors in db.execute('SELECT name, runs, ices, new_ices, timeouts, errors FROM option_stats'):
+            self.option_weights[name] = relative_ice_rate(runs, found, new_ices)
+        self.source_weights = {}
+        for name, runs, found, new_ices, timeouts, errors in db.execute('SELECT name, runs, ices, new_ices, timeouts, errors FROM source_stats'):
+            usable = (runs - timeouts - errors + 1) / (runs + 2)
+            self.source_weights[name] = relative_ice_rate(runs, found, new_ices) * usable
+
+    def choose(self, options, count):
+        self.refresh()
+        if self.sources == None:
+            self.sources = sorted(source_files)
+        if random.random() < EXPLORATION:
+            return ([random.choice(options) for option in range(count)], random.choice(self.sources))
+
+        # unknown ones have the average weight
+        weights = [self.option_weights.get(o.name, 1) for o in options]
+        chosen = random.choices(options, weights, k = count)
+        weights = [self.source_weights.get(source, 1) for source in self.sources]
+        return (chosen, random.choices(self.sources, weights)[0])
+
+    def record(self, options, source, outcome, cpu_time):
+        values = (outcome == 'ice' or outcome == 'new', outcome == 'new', outcome == 'timeout', outcome == 'error', cpu_time)
+        db = ices.connect()
+        db.execute('BEGIN')
+        for table, names in (('option_stats', set(o.name for o in options)), ('source_stats', [source])):
+            db.executemany(f'INSERT INTO {table} VALUES (?, 1, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET runs = runs + 1, '
+                           'ices = ices + excluded.ices, new_ices = new_ices + excluded.new_ices, '
+                           'timeouts = timeouts + excluded.timeouts, errors = errors + excluded.errors, '
+                           'cpu_time = cpu_time + excluded.cpu_time', [(name,) + values for name in names])
+        db.execute('COMMIT')
+
+    def top_options(self, count):
+        return ices.connect().execute('SELECT name, new_ices, ices, runs FROM option_stats WHERE new_ices > 0 '
+                                      'ORDER BY new_ices DESC, ices DESC LIMIT ?', (count,)).fetchall()
+
+scheduler = Scheduler()
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
 class BooleanFlag:
     def __init__(self, name, default):
         self.name = name
@@ -364,6 +562,14 @@ class OptimizationLevel:
         self.level = level
         self.options = []
 
+        # the parsed and validated options are cached for the compiler
+        cache = os.path.join(args.cache_dir, f'options-{compiler_id}{self.level}.pickle')
+        cached = load_cache(cache, None)
+        if cached != None:
+            self.options = cached
+            print('Options for %s: %d (cached)' % (self.level, len(self.options)))
+            return
+
         self.options.append(MarchFlag())
         self.parse_options('target')
         self.parse_options('optimize')
@@ -372,6 +578,7 @@ class OptimizationLevel:
         self.add_interesting_options()
 
         self.options = self.filter_options(self.options)
+        save_cache(cache, self.options)
         print('Options for %s: %d' % (self.level, len(self.options)))
 
     def print_options(self):
@@ -490,7 +697,6 @@ class OptimizationLevel:
             self.options.append(EnumFlag('-fsanitize=', None, sanitize_values, False))
 
     def filter_options(self, l):
-        filtered = []
         skipped_options = {'-fselective-scheduling', '-fselective-scheduling2', '-mlra', '-fsave-optimization-record',
                 '-Werror', '-fmodulo-sched', '--param=destructive-interference-size', '--param=constructive-interference-size',
                 '-gstatement-frontiers'}
@@ -515,6 +721,7 @@ class OptimizationLevel:
         if args.target != 'x86_64':
             skipped_options.add('-freorder-blocks-and-partition')
 
+        candidates = []
         for option in self.options:
             if option.name in skipped_options:
                 continue
@@ -524,35 +731,45 @@ class OptimizationLevel:
                 if type(option) is MarchFlag:
                     option.ignore_m32 = True
 
-            r = option.check_option(self.level)
-            if r:
-                filtered.append(option)
+            candidates.append(option)
+
+        # every check spawns the compiler, run them in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor:
+            valid = list(executor.map(lambda option: option.check_option(self.level), candidates))
 
-        return filtered
+        return [option for option, r in zip(candidates, valid) if r]
 
     def test(self, option_count):
-        options = [random.choice(self.options) for option in range(option_count)]
-        source_file = random.sample(list(source_files), 1)[0]
+        chosen, source_file = scheduler.choose(self.options, option_count)
         compiler = get_compiler_by_extension(source_file)
-        options = [o.select_nondefault() for o in options]
+        options = [o.select_nondefault() for o in chosen]
 
         # TODO: warning
         cmd = f'timeout %d %s %s -fmax-errors=1 -I{LLVM_DIR}/libcxx/test/support/ -Wno-overflow %s %s %s -o/dev/null -S' % (args.timeout, compiler, args.cflags, self.level, source_file, ' '.join(options))
 
+        # the worker runs one compiler at a time
+        cpu_time = children_cpu_time()
         r = subprocess.run(cmd, shell = True, capture_output=True, env = my_env)
+        cpu_time = children_cpu_time() - cpu_time
+        outcome = 'ok'
         if r.returncode != 0:
+            outcome = 'timeout' if r.returncode == 124 else 'error'
             try:
                 stderr = r.stderr.decode('utf-8')
                 ice = find_ice(stderr)
                 # TODO: remove
-                if ice != None and not ice[1] in ice_cache and not any([x in ice[0] for x in known_bugs.keys()]):
-                    ice_locations.add(ice[0])
-                    ice_cache.add(ice[1])
-                    print(colored('warning: NEW ICE #%d: %s' % (len(ice_cache), ice[0]), 'red'))
+                signature = None
+                if ice != None:
+                    outcome = 'ice'
+                if ice != None and not any([x in ice[0] for x in known_bugs.keys()]):
+                    signature = ices.claim(ice, cmd)
+                if signature != None:
+                    outcome = 'new'
+                    print(colored('warning: NEW ICE #%d: %s' % (ices.count(), ice[0]), 'red'))
                     print(cmd)
                     print(ice[1])
                     print()
-                    self.reduce(cmd)
+                    ices.reduced(signature, self.reduce(cmd))
                     sys.stdout.flush()
                 elif args.logging:
                     logging.debug(cmd)
@@ -562,18 +779,24 @@ class OptimizationLevel:
             if r.returncode == 124 and args.verbose:
                 print(colored('TIMEOUT:', 'red'))
                 print(cmd)
+        scheduler.record(chosen, source_file, outcome, cpu_time)
 
     def reduce(self, cmd):
         r = subprocess.run(os.path.join(script_dir, "gcc-reduce-flags.py") + " '" + cmd + "'", shell = True, capture_output=True)
         assert r.returncode == 0
         reduced_command = r.stdout.decode('utf-8').strip()
         print(colored('Reduced command: ' + reduced_command, 'green'))
+        return reduced_command
 
 
 os.chdir('/tmp/')
+threads = 32
+compiler_id = compiler_identity()
+validity_cache = os.path.join(args.cache_dir, f'validity-{compiler_id}.pickle')
+option_validity_cache = load_cache(validity_cache, {})
 levels = [OptimizationLevel(x) for x in ['', '-O0', '-O1', '-O2', '-O3', '-Ofast', '-Os', '-Oz', '-Og']]
+save_cache(validity_cache, option_validity_cache)
 
-threads = 32
 counter = 1000 * args.iterations
 lock = Lock()
 
@@ -611,9 +834,21 @@ if args.filter:
     source_files = filtered_source_files
     print('Filtered source files: %d.' % len(source_files))
 
+start = time()
+start_cpu_time = children_cpu_time()
 with Pool(threads) as p:
     p.map(test, range(counter))
 
 print('=== SUMMARY ===')
-for i in ice_locations:
-    print('ICE: %s' % i)
+found = ices.found_since(start)
+for location, reduced, hits in found:
+    print('ICE: %s (hit %d times)' % (location, hits))
+    if reduced != None:
+        print('  %s' % reduced)
+
+# the workers are reaped, their CPU time includes the compilers and reductions
+cpu_hours = (children_cpu_time() - start_cpu_time) / 3600
+if cpu_hours:
+    print('New ICEs: %d in %.2f CPU hours (%.2f per CPU hour)' % (len(found), cpu_hours, len(found) / cpu_hours))
+for name, new_ices, found_ices, runs in scheduler.top_options(10):
+    print('Option %s: %d new ICEs, %d ICEs in %d tests' % (name, new_ices, found_ices, runs))
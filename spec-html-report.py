@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import datetime
 import os
 import re
@@ -12,10 +13,19 @@ perf_record_prefix = 'perf record --call-graph dwarf'
 perf_record_regex = re.compile(r'\s+([^\s]*)%\s+(?P<percent>[^\s]*)%\s*(?P<samples>[\d]+)'
                                r'\s*([^\s]*)\s*(?P<shobj>[^\s]*)\s*\[.\]\s(?P<function>.*)')
 perf_annotate_regex = re.compile(r'\s+(?P<percent>[0-9]+\.[0-9]+)\s+:.*')
+# every annotated symbol starts with the ' Percent | Source code & Disassembly of ...' header
+perf_annotate_header_regex = re.compile(r'\s*Percent\s+\|')
+perf_annotate_symbol_regex = re.compile(r'\s*:\s+[0-9a-f]+ <(?P<symbol>.+)>:\s*$')
+ansi_escape_regex = re.compile(r'\x1b\[[0-9;]*m')
 context_size = 15
 threshold_percent = 1
 perf_annotate_threshold = 0.3
 output_folder = 'html'
+# perf data and stage markers of every benchmark, finished stages are skipped on rerun
+work_folder = 'html-work'
+# stage -> stages using its results
+stage_dependents = {'build': ['stat', 'record'], 'stat': ['html'], 'record': ['flamegraph', 'html'],
+                    'flamegraph': [], 'html': []}
 
 int_benchmarks = ['500.perlbench_r', '502.gcc_r', '505.mcf_r', '520.omnetpp_r', '523.xalancbmk_r',
                   '525.x264_r', '531.deepsjeng_r', '541.leela_r', '548.exchange2_r', '557.xz_r']
@@ -40,12 +50,23 @@ HTML_FOOTER = """
     </main></div><footer><div class="container">%s</div></footer></body></html>
 """
 
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 parser = argparse.ArgumentParser(description='SPEC perf analysis HTML report generator')
 parser.add_argument('machine', help='Machine name')
 parser.add_argument('compiler', help='Compiler name')
 parser.add_argument('options', help='Compiler options')
 parser.add_argument('spec_config', help='SPEC configuration file')
 parser.add_argument('--benchmarks', help='List of benchmarks to run (all by default)')
+parser.add_argument('-j', '--jobs', type=positive_int, default=1,
+                    help='Number of benchmarks post-processed in parallel with the measurement (default: 1)')
+parser.add_argument('--force', action='store_true', help='Run all stages even if they are already done')
 args = parser.parse_args()
 
 spec_script = f'runcpu --config={args.spec_config} --size=ref --iterations=1  --no-reportable --tune=peak'
@@ -79,13 +100,47 @@ def decode_perf_annotate(data):
         return data.decode('latin1')
 
 
-def demangle(function):
-    return subprocess.check_output(f'c++filt "{function}"', shell=True, encoding='utf8').strip()
+def demangle_all(functions):
+    # c++filt demangles line by line, a single process handles all functions
+    functions = list(functions)
+    output = subprocess.check_output('c++filt', input='\n'.join(functions), shell=True, encoding='utf8')
+    return dict(zip(functions, output.splitlines()))
+
+
+def strip_ansi(data):
+    return ansi_escape_regex.sub('', data)
+
+
+def split_perf_annotate(data):
+    annotations = {}
+    lines = data.split('\n')
+    starts = [i for i, line in enumerate(lines) if perf_annotate_header_regex.match(strip_ansi(line))]
+    for start, end in zip(starts, starts[1:] + [len(lines)]):
+        for line in lines[start:end]:
+            m = perf_annotate_symbol_regex.match(strip_ansi(line))
+            if m:
+                # the same symbol name can be in multiple DSOs, the first one has the most samples
+                annotations.setdefault(m.group('symbol'), '\n'.join(lines[start:end]))
+                break
+    return annotations
 
 
-def filter_perf_script():
+def annotate(perf_data, functions):
+    # a single pass over perf.data annotates all functions above the threshold
+    cmd = f'perf --buildid-dir none annotate -i {perf_data} --no-demangle --stdio --stdio-color=always -l'
+    annotations = split_perf_annotate(decode_perf_annotate(
+        subprocess.check_output(f'{cmd} --percent-limit={threshold_percent}', shell=True)))
+    for function in functions:
+        if function not in annotations:
+            print(f'  ... annotating {function} separately')
+            annotations[function] = decode_perf_annotate(
+                subprocess.check_output(f'{cmd} --symbol={function}', shell=True))
+    return annotations
+
+
+def filter_perf_script(perf_data):
     output = []
-    data = subprocess.check_output('perf script', shell=True, encoding='utf8')
+    data = subprocess.check_output(f'perf script -i {perf_data}', shell=True, encoding='utf8')
     records = data.strip().split('\n\n')
     for record in records:
         binary = record.split('\n')[0].split(' ')[0]
@@ -94,10 +149,9 @@ def filter_perf_script():
     return '\n\n'.join(output).encode()
 
 
-def write_hot_perf_annotate_hunks(data, data_nocolor):
+def write_hot_perf_annotate_hunks(data):
     color_lines = data.split('\n')
-    nocolor_lines = data_nocolor.split('\n')
-    assert len(color_lines) == len(nocolor_lines)
+    nocolor_lines = strip_ansi(data).split('\n')
     # add header to interesting spots
     lines_to_output = set(range(30))
 
@@ -144,34 +198,76 @@ def check_dependencies():
         sys.exit(2)
 
 
-check_dependencies()
-os.chdir(os.path.expanduser('~/Programming/cpu2017'))
-if not os.path.exists(output_folder):
-    os.mkdir(output_folder)
+def stage_done(folder, stage):
+    return not args.force and os.path.exists(os.path.join(folder, f'{stage}.done'))
+
+
+def start_stage(folder, stage):
+    # results of the dependent stages are based on the old data
+    marker = os.path.join(folder, f'{stage}.done')
+    if os.path.exists(marker):
+        os.remove(marker)
+    for dependent in stage_dependents[stage]:
+        start_stage(folder, dependent)
+
 
-for i, benchmark in enumerate(benchmarks):
-    title = f'{benchmark} - {args.machine} - {args.compiler} {args.options}'
-    print(f'== {i + 1}/{len(benchmarks)}: {title} ==')
-    subprocess.check_output(f'source ./shrc && {spec_script}  --action build -D {benchmark}', shell=True)
+def mark_stage_done(folder, stage):
+    open(os.path.join(folder, f'{stage}.done'), 'w').close()
+
+
+def measure(benchmark, folder):
+    # measurements run one at a time so that they do not perturb each other
+    if not stage_done(folder, 'build'):
+        start_stage(folder, 'build')
+        subprocess.check_output(f'source ./shrc && {spec_script}  --action build -D {benchmark}', shell=True)
+        mark_stage_done(folder, 'build')
     print('  ... build done')
-    cmd = f'source ./shrc && perf stat -- {spec_script} --action run {benchmark}'
-    r = subprocess.run(cmd, shell=True, encoding='utf8', stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-    assert r.returncode == 0
-    stats = r.stderr.strip()
+
+    if not stage_done(folder, 'stat'):
+        start_stage(folder, 'stat')
+        cmd = f'source ./shrc && perf stat -- {spec_script} --action run {benchmark}'
+        r = subprocess.run(cmd, shell=True, encoding='utf8', stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        assert r.returncode == 0
+        with open(os.path.join(folder, 'stat.txt'), 'w') as f:
+            f.write(r.stderr.strip())
+        mark_stage_done(folder, 'stat')
     print('  ... perf stat done')
-    cmd = f'source ./shrc && perf record -F150 -o perf.data --call-graph dwarf {spec_script} --action run {benchmark}'
-    subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
-    r = subprocess.check_output('perf report --no-demangle --stdio -g none --show-nr-samples',
+
+    if not stage_done(folder, 'record'):
+        start_stage(folder, 'record')
+        cmd = (f'source ./shrc && perf record -F150 -o {folder}/perf.data --call-graph dwarf {spec_script} '
+               f'--action run {benchmark}')
+        subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+        mark_stage_done(folder, 'record')
+    print('  ... perf record done')
+
+
+def post_process(benchmark, title, filename, folder):
+    perf_data = os.path.join(folder, 'perf.data')
+    if not stage_done(folder, 'flamegraph'):
+        start_stage(folder, 'flamegraph')
+        flamegraph = os.path.join(output_folder, f'{filename}.svg')
+        perf_script_output = filter_perf_script(perf_data)
+        cmd = f'~/Programming/FlameGraph/stackcollapse-perf.pl --context > {folder}/stacks.txt ' \
+              f'&& ~/Programming/FlameGraph/flamegraph.pl --title {benchmark} --minwidth 3 {folder}/stacks.txt ' \
+              f'> {flamegraph}'
+        subprocess.check_output(cmd, input=perf_script_output, shell=True)
+        mark_stage_done(folder, 'flamegraph')
+    print(f'  ... {benchmark}: flame graph done')
+
+    if stage_done(folder, 'html'):
+        return
+    start_stage(folder, 'html')
+    r = subprocess.check_output(f'perf report -i {perf_data} --no-demangle --stdio -g none --show-nr-samples',
                                 shell=True, encoding='utf8')
-    print('  ... perf report done')
+    print(f'  ... {benchmark}: perf report done')
     report = parse_spec_report(r.splitlines())
-    filename = f'{benchmark}-{args.machine}-{args.compiler}-{args.options}'
-    filename = filename.replace(' ', '_').replace('-', '_')
-    flamegraph = os.path.join(output_folder, f'{filename}.svg')
-    perf_script_output = filter_perf_script()
-    cmd = f'~/Programming/FlameGraph/stackcollapse-perf.pl --context > tmp.txt ' \
-          f'&& ~/Programming/FlameGraph/flamegraph.pl --title {benchmark} --minwidth 3 tmp.txt > {flamegraph}'
-    subprocess.check_output(cmd, input=perf_script_output, shell=True)
+    functions = sorted(report.items(), key=lambda x: x[1], reverse=True)
+    demangled = demangle_all(report)
+    annotations = annotate(perf_data, report)
+    print(f'  ... {benchmark}: perf annotate done')
+    with open(os.path.join(folder, 'stat.txt')) as f:
+        stats = f.read()
 
     with open(os.path.join(output_folder, filename + '.html'), 'w+') as f:
         f.write(HTML_HEADER % (title, title))
@@ -183,19 +279,45 @@ for i, benchmark in enumerate(benchmarks):
         f.write('<h3>Perf annotate</h3>')
         f.write('<table class="table"><thead><th>Function</th><th class="text-end">Samples</th>'
                 '<th class="text-end">Percentage</th></thead><tbody>')
-        for mangled_function, (percentage, samples) in sorted(report.items(), key=lambda x: x[1], reverse=True):
-            function = demangle(mangled_function)
+        for mangled_function, (percentage, samples) in functions:
+            function = demangled[mangled_function]
             f.write(f'<tr><td><a href="#{mangled_function}">{escape(function)}</a></td>'
                     f'<td class="text-end">{samples}</td><td class="text-end">{percentage:.2f} %</td></tr>')
         f.write('<tbody></table>')
-        for mangled_function, (percentage, samples) in sorted(report.items(), key=lambda x: x[1], reverse=True):
-            function = demangle(mangled_function)
+        for mangled_function, (percentage, samples) in functions:
+            function = demangled[mangled_function]
             f.write(f'<h5 id="{mangled_function}">{percentage:.2f}% ({samples} samples) - {escape(function)}</h5>')
-            cmd = f'perf --buildid-dir none annotate --no-demangle --symbol={mangled_function} ' \
-                  f'--stdio --stdio-color=always -l'
-            data = decode_perf_annotate(subprocess.check_output(cmd, shell=True))
-            data_nocolor = decode_perf_annotate(subprocess.check_output(cmd + ' --stdio-color=never', shell=True))
             f.write('<pre style="font-size: 8pt;">')
-            f.write(write_hot_perf_annotate_hunks(data, data_nocolor))
+            f.write(write_hot_perf_annotate_hunks(annotations[mangled_function]))
             f.write('</pre>')
         f.write(HTML_FOOTER % f'Generated {datetime.datetime.now()}')
+    mark_stage_done(folder, 'html')
+    print(f'  ... {benchmark}: HTML report done')
+
+
+check_dependencies()
+os.chdir(os.path.expanduser('~/Programming/cpu2017'))
+os.makedirs(output_folder, exist_ok=True)
+
+# post-processing of a benchmark runs while the next one is measured
+failed = []
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+    futures = {}
+    for i, benchmark in enumerate(benchmarks):
+        title = f'{benchmark} - {args.machine} - {args.compiler} {args.options}'
+        print(f'== {i + 1}/{len(benchmarks)}: {title} ==')
+        filename = f'{benchmark}-{args.machine}-{args.compiler}-{args.options}'
+        filename = filename.replace(' ', '_').replace('-', '_')
+        folder = os.path.abspath(os.path.join(work_folder, filename))
+        os.makedirs(folder, exist_ok=True)
+        measure(benchmark, folder)
+        futures[executor.submit(post_process, benchmark, title, filename, folder)] = benchmark
+
+    for future in concurrent.futures.as_completed(futures):
+        if future.exception():
+            print(f'Post-processing of {futures[future]} failed: {future.exception()}')
+            failed.append(futures[future])
+
+if failed:
+    print(f'Failed benchmarks (run again to retry): {" ".join(failed)}')
+    sys.exit(3)
@@ -5,7 +5,9 @@
 #
 # that can be opened in https://ui.perfetto.dev/ for inspection.
 
+import argparse
 import json
+import os
 import time
 
 import psutil
@@ -14,7 +16,137 @@ import psutil
 OUTPUT_FILE = 'trace.json'
 INTERVAL = 0.25
 
-trace_data = []
+parser = argparse.ArgumentParser(description='Record system counters as a trace viewable in Perfetto')
+parser.add_argument('-o', '--output', default=OUTPUT_FILE, help=f'Output file (default: {OUTPUT_FILE})')
+parser.add_argument('-i', '--interval', type=float, default=INTERVAL,
+                    help=f'Sampling interval in seconds (default: {INTERVAL})')
+parser.add_argument('-r', '--retention', type=float,
+                    help='Keep only about the last RETENTION seconds of the trace')
+parser.add_argument('-p', '--processes', type=int, default=0, metavar='N',
+                    help='Add CPU and RSS counter tracks of the top N processes')
+args = parser.parse_args()
+
+
+class TraceWriter:
+    """Stream events to a file in the JSON Array Format of the Trace Event Format.
+
+    The closing bracket is optional in the format, so the trace can be opened even when
+    the script is killed. With retention, events go to segment files covering RETENTION
+    seconds each, only the last two segments are kept and they become the output at the end.
+    """
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self.segments = []
+        self.file = None
+        self.segment_start = None
+        self.metadata = {}
+
+    def open_segment(self, ts):
+        if self.file:
+            self.file.close()
+        path = f'{self.path}.segment-{len(self.segments)}' if self.retention else self.path
+        self.segments.append(path)
+        # the segment before the previous one is older than the retention
+        if len(self.segments) > 2:
+            os.remove(self.segments[-3])
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.first = True
+        self.segment_start = ts
+        # every segment has to name the processes on its own
+        for event in self.metadata.values():
+            self.write_event(event)
+
+    def write_event(self, event):
+        if not self.first:
+            self.file.write(',\n')
+        self.file.write(json.dumps(event))
+        self.first = False
+
+    def write(self, events, ts):
+        if not self.file or (self.retention and ts - self.segment_start >= convert_time(self.retention)):
+            self.open_segment(ts)
+        for event in events:
+            self.write_event(event)
+        self.file.flush()
+
+    def name_process(self, pid, name):
+        event = {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+        self.metadata[pid] = event
+        return event
+
+    def forget_process(self, pid):
+        self.metadata.pop(pid, None)
+
+    def close(self):
+        if not self.file:
+            return
+        self.file.write('\n]\n')
+        self.file.close()
+        if self.retention:
+            with open(self.path, 'w') as output:
+                output.write('[\n')
+                first = True
+                for path in self.segments[-2:]:
+                    with open(path) as f:
+                        for line in f:
+                            line = line.rstrip(',\n')
+                            if line in ('[', ']'):
+                                continue
+                            if not first:
+                                output.write(',\n')
+                            output.write(line)
+                            first = False
+                    os.remove(path)
+                output.write('\n]\n')
+
+
+class ProcessTracker:
+    """Counter tracks of the processes that use the most CPU or memory."""
+
+    def __init__(self, count):
+        self.count = count
+        # (pid, create time) -> CPU time
+        self.cpu_times = {}
+        self.tracked = set()
+
+    def sample(self, elapsed, ts):
+        usage = []
+        cpu_times = {}
+        for proc in psutil.process_iter(['name', 'cpu_times', 'memory_info', 'create_time']):
+            info = proc.info
+            if not info['cpu_times'] or not info['memory_info']:
+                # the process can be gone or inaccessible
+                continue
+            key = (proc.pid, info['create_time'])
+            cpu_time = info['cpu_times'].user + info['cpu_times'].system
+            cpu_times[key] = cpu_time
+            cpu = 100 * (cpu_time - self.cpu_times[key]) / elapsed if key in self.cpu_times else 0
+            usage.append((proc.pid, info['name'], cpu, info['memory_info'].rss))
+        self.cpu_times = cpu_times
+
+        top = sorted(usage, key=lambda x: x[2], reverse=True)[:self.count]
+        top += sorted(usage, key=lambda x: x[3], reverse=True)[:self.count]
+        events = []
+        tracked = set()
+        for pid, name, cpu, rss in top:
+            if pid in tracked:
+                continue
+            if pid not in self.tracked:
+                events.append(trace.name_process(pid, f'{name} ({pid})'))
+            tracked.add(pid)
+            events.append({'name': 'CPU usage', 'ph': 'C', 'ts': ts, 'pid': pid, 'args': {'%': cpu}})
+            events.append({'name': 'RSS', 'ph': 'C', 'ts': ts, 'pid': pid, 'args': {'bytes': rss}})
+        # a counter keeps its last value, drop the ones no longer tracked to zero
+        for pid in self.tracked - tracked:
+            events.append({'name': 'CPU usage', 'ph': 'C', 'ts': ts, 'pid': pid, 'args': {'%': 0}})
+            events.append({'name': 'RSS', 'ph': 'C', 'ts': ts, 'pid': pid, 'args': {'bytes': 0}})
+            trace.forget_process(pid)
+        self.tracked = tracked
+        return events
+
 
 # initial values
 vm_initial = psutil.virtual_memory()
@@ -41,30 +173,38 @@ DISK_UNITS = {
 }
 
 
+trace = TraceWriter(args.output, args.retention)
+processes = ProcessTracker(args.processes) if args.processes else None
+last_tick = time.monotonic()
+
 try:
     while True:
         # CPU
-        cpu_percent = psutil.cpu_percent(percpu=False, interval=INTERVAL)
+        cpu_percent = psutil.cpu_percent(percpu=False, interval=args.interval)
         ts = convert_time(time.time())
-        trace_data.append({'name': 'CPU usage', 'category': 'CPU', 'ph': 'C',
-                           'ts': ts, 'args': {'average': cpu_percent}})
+        # rates are computed from the real time of the tick, sampling takes time as well
+        now = time.monotonic()
+        elapsed = now - last_tick
+        last_tick = now
+        events = [{'name': 'CPU usage', 'category': 'CPU', 'ph': 'C',
+                   'ts': ts, 'args': {'average': cpu_percent}}]
 
         # USED MEMORY
         used = psutil.virtual_memory().used
-        trace_data.append({'name': 'Used memory', 'category': 'Memory',
-                           'ph': 'C', 'ts': ts,
-                           'args': {'bytes': max(0, used - vm_initial.used)}})
+        events.append({'name': 'Used memory', 'category': 'Memory',
+                       'ph': 'C', 'ts': ts,
+                       'args': {'bytes': max(0, used - vm_initial.used)}})
 
         # DISK USAGE
         disk_counters = psutil.disk_io_counters()
         if last_disk_counters:
+            entry = {'name': 'Disk', 'category': 'Disk',
+                     'ph': 'C', 'ts': ts, 'args': {}}
             for field in disk_counters._fields:
-                entry = {'name': 'Disk', 'category': 'Disk',
-                         'ph': 'C', 'ts': ts, 'args': {}}
                 last = getattr(last_disk_counters, field)
                 current = getattr(disk_counters, field)
-                entry['args'][f'{field} ({DISK_UNITS[field]})'] = (current - last) / INTERVAL
-                trace_data.append(entry)
+                entry['args'][f'{field} ({DISK_UNITS[field]})'] = (current - last) / elapsed
+            events.append(entry)
 
         last_disk_counters = disk_counters
 
@@ -74,20 +214,25 @@ try:
         sent_value = net_counters.bytes_sent
 
         first = last_net_counters[0] == 0
-        received_per_sec = (received_value - last_net_counters[0]) / INTERVAL
-        sent_per_sec = (sent_value - last_net_counters[1]) / INTERVAL
+        received_per_sec = (received_value - last_net_counters[0]) / elapsed
+        sent_per_sec = (sent_value - last_net_counters[1]) / elapsed
         last_net_counters = [received_value, sent_value]
         if not first:
-            trace_data.append({'name': 'Network (bytes/s)',
-                               'category': 'Network',
-                               'ph': 'C', 'ts': ts,
-                               'args': {'received': received_per_sec,
-                                        'sent': sent_per_sec}})
+            events.append({'name': 'Network (bytes/s)',
+                           'category': 'Network',
+                           'ph': 'C', 'ts': ts,
+                           'args': {'received': received_per_sec,
+                                    'sent': sent_per_sec}})
+
+        # PROCESSES
+        if processes:
+            events += processes.sample(elapsed, ts)
+
+        trace.write(events, ts)
 
 
 except KeyboardInterrupt:
     pass
 
-with open(OUTPUT_FILE, 'w') as f:
-    print(f'\nSaving output to: {OUTPUT_FILE}')
-    f.write(json.dumps({'traceEvents': trace_data}))
+print(f'\nSaving output to: {args.output}')
+trace.close()
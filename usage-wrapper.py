@@ -2,13 +2,14 @@
 
 import argparse
 import datetime
+import json
 import math
 import os
 import subprocess
 import sys
 import threading
 import time
-from itertools import chain
+from array import array
 
 try:
     import psutil
@@ -19,9 +20,11 @@ except ImportError:
 try:
     import matplotlib
     import matplotlib.pyplot as plt
+    import numpy as np
     from matplotlib.lines import Line2D
 except ImportError:
     plt = None
+    np = None
 
 
 def to_gigabyte(value):
@@ -32,20 +35,192 @@ def to_megabyte(value):
     return value / 1024**2
 
 
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_pss(pid):
+    """Return the proportional set size (in bytes) from /proc/<pid>/smaps_rollup."""
+    for line in read_file(f'/proc/{pid}/smaps_rollup').splitlines():
+        if line.startswith(b'Pss:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def read_pressure(resource):
+    """Return the total time (in seconds) some tasks were stalled on the resource."""
+    # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    some = read_file(f'/proc/pressure/{resource}').splitlines()[0]
+    return int(some.rpartition(b'total=')[2]) / 10**6
+
+
+def get_cgroup_memory_files():
+    """Return the current and peak memory files of the cgroup of the wrapper.
+
+    The cgroup encloses the command, but it is usually shared with other processes
+    (e.g. a login session scope) and its peak can predate the command.
+    """
+    try:
+        lines = read_file('/proc/self/cgroup').decode().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        if controllers == 'memory':
+            # cgroup v1
+            folder = f'/sys/fs/cgroup/memory{path}'
+            files = (f'{folder}/memory.usage_in_bytes', f'{folder}/memory.max_usage_in_bytes')
+        elif not controllers:
+            folder = f'/sys/fs/cgroup{path}'
+            files = (f'{folder}/memory.current', f'{folder}/memory.peak')
+        else:
+            continue
+        # the root cgroup does not account memory
+        if os.path.exists(files[0]):
+            return files
+    return None
+
+
+def open_cgroup_memory_peak(path):
+    """Return a descriptor of memory.peak reset to the current usage, None if not supported.
+
+    Since Linux 6.12, a write to memory.peak resets the peak seen through the same descriptor,
+    so the value read at the end is the peak during the command. Otherwise only the sampled
+    usage is known, the peak of the enclosing cgroup can predate the command.
+    """
+    if not path.endswith('/memory.peak'):
+        return None
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        os.write(fd, b'reset\n')
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
 INTERVAL = 0.33
+PROCESS_INTERVAL = 0.05
+# shorter parts of the critical path are only counted
+CRITICAL_PATH_MIN = 0.1
 LW = 0.5
+SPILL_SAMPLES = 1000
+PROCESS_SAMPLE_COLUMNS = ('sample', 'process', 'rss', 'pss', 'cpu')
+# resource -> color in graph
+PRESSURE_RESOURCES = {'cpu': 'blue', 'memory': 'purple', 'io': 'red'}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
 
 disk_data_total = to_gigabyte(psutil.disk_usage('.').total)
 disk_data_start = to_gigabyte(psutil.disk_usage('.').used)
 
 
+class TraceWriter:
+    """Trace of a run: JSON lines, a line with 'columns' is followed by the raw float64 columns."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+
+    def write(self, record, columns=None):
+        if columns:
+            record = dict(record, length=len(next(iter(columns.values()))), columns=list(columns))
+        with self.lock:
+            self.file.write(json.dumps(record).encode() + b'\n')
+            for column in (columns or {}).values():
+                column.tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Yield (record, columns) pairs stored in a trace."""
+    with open(path, 'rb') as f:
+        while line := f.readline():
+            record = json.loads(line)
+            columns = {}
+            for name in record.get('columns', []):
+                columns[name] = array('d')
+                columns[name].fromfile(f, record['length'])
+            yield (record, columns)
+
+
+class Samples:
+    """Columnar storage of samples, one growable float64 array per metric.
+
+    A column that appears later is padded with zeros for the previous samples.
+    With a trace, every SPILL_SAMPLES samples are moved from memory to the trace
+    and load() reads them back.
+    """
+
+    def __init__(self, trace=None):
+        self.columns = {}
+        self.length = 0
+        self.trace = trace
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = array('d', [0.0]) * self.length
+        return self.columns[name]
+
+    def array(self, name):
+        return np.frombuffer(self.column(name))
+
+    def append(self, row):
+        for name in row:
+            self.column(name)
+        for name, column in self.columns.items():
+            column.append(row.get(name, 0.0))
+        self.length += 1
+        if self.trace and self.length >= SPILL_SAMPLES:
+            self.spill()
+
+    def extend(self, columns, length):
+        for name, values in columns.items():
+            self.column(name).extend(values)
+        self.length += length
+        for column in self.columns.values():
+            if len(column) < self.length:
+                column.extend(array('d', [0.0]) * (self.length - len(column)))
+
+    def spill(self):
+        if not self.length:
+            return
+        self.trace.write({'type': 'samples'}, self.columns)
+        self.columns = {name: array('d') for name in self.columns}
+        self.length = 0
+
+    def load(self, path):
+        self.columns = {}
+        self.length = 0
+        for record, columns in read_trace(path):
+            if record['type'] == 'samples':
+                self.extend(columns, record['length'])
+
+
 class DataStatistic:
-    def __init__(self, collect_fn):
+    def __init__(self, name, collect_fn):
+        self.name = name
         self.collect_fn = collect_fn
-        self.values = []
 
     def collect(self):
-        self.values.append(self.collect_fn())
+        return self.collect_fn()
+
+    @property
+    def values(self):
+        return samples.column(self.name)
+
+    @values.setter
+    def values(self, values):
+        samples.columns[self.name] = array('d', values)
+
+    def array(self):
+        return samples.array(self.name)
 
     def maximum(self):
         return max(self.values)
@@ -61,22 +236,39 @@ class DataStatistic:
 
 
 class DiskDataStatistic(DataStatistic):
-    def __init__(self, collect_fn):
+    def __init__(self, name, collect_fn):
         self.latest_value = collect_fn()
-        self.start_value = collect_fn()
-        super().__init__(collect_fn)
+        super().__init__(name, collect_fn)
 
     def collect(self):
         value = self.collect_fn()
-        self.values.append(value - self.latest_value)
+        difference = value - self.latest_value
         self.latest_value = value
+        return difference
+
 
-    def difference_in_gb(self):
-        return (self.latest_value - self.start_value) / 1024
+class PressureStatistic(DataStatistic):
+    """Share of time (in %) some tasks were stalled on the resource since the previous sample."""
+
+    def __init__(self, resource, replay=False):
+        self.resource = resource
+        self.color = PRESSURE_RESOURCES[resource]
+        if not replay:
+            self.latest_value = (read_pressure(resource), time.monotonic())
+        super().__init__(f'pressure-{resource}', None)
+
+    def collect(self):
+        value = (read_pressure(self.resource), time.monotonic())
+        stall, elapsed = (value[0] - self.latest_value[0], value[1] - self.latest_value[1])
+        self.latest_value = value
+        return 100 * stall / elapsed if elapsed > 0 else 0
+
+
+def disk_total_in_gb(stat):
+    # the values are differences of consecutive samples
+    return sum(stat.values) / 1024
 
 
-timestamps = []
-process_usage = []
 process_hogs = {}
 
 process_name_map = {}
@@ -84,6 +276,8 @@ lock = threading.Lock()
 
 done = False
 start_ts = time.monotonic()
+# /proc/<pid>/stat start times are relative to the boot
+BOOT_OFFSET = time.clock_gettime(time.CLOCK_BOOTTIME) - time.monotonic()
 
 special_processes = {
     'linker': 'gold',
@@ -135,16 +329,45 @@ parser.add_argument(
 parser.add_argument(
     '-f', '--frequency', type=float, default=INTERVAL, help='Frequency of measuring (in seconds)'
 )
+parser.add_argument(
+    '--process-frequency',
+    type=float,
+    default=PROCESS_INTERVAL,
+    help='Frequency of polling for started and finished processes (in seconds)',
+)
+parser.add_argument(
+    '-p',
+    '--critical-path',
+    action='store_true',
+    help='Report the longest serial chain of processes',
+)
 parser.add_argument(
     '-j',
     '--jobs',
     type=int,
-    default=cpu_count,
     dest='used_cpus',
     help='Scale up CPU data to used CPUs ' 'instead of available CPUs',
 )
 parser.add_argument('--y-scale', type=int, help='Minimal y-scale (in GiB)')
 parser.add_argument('--skip-gpu', action='store_false', help='Skip collecting statistics for GPU')
+parser.add_argument(
+    '--rss',
+    action='store_true',
+    help='Account process memory by RSS instead of PSS (cheaper, but shared pages are counted repeatedly)',
+)
+parser.add_argument(
+    '--trace',
+    help='Write all samples and processes to a trace file (keeps only recent samples in memory)',
+)
+parser.add_argument(
+    '-r',
+    '--replay',
+    metavar='TRACE',
+    help='Render graph and summary from a trace, do not run anything',
+)
+parser.add_argument(
+    '-d', '--diff', nargs=2, metavar='TRACE', help='Compare per-category usage of two traces'
+)
 
 args = parser.parse_args()
 
@@ -160,20 +383,49 @@ if not args.summary_only and plt is None:
     )
     sys.exit(1)
 
-cpu_scale = cpu_count / args.used_cpus
-cpu_stats = DataStatistic(lambda: psutil.cpu_percent(interval=args.frequency) * cpu_scale)
-mem_stats = DataStatistic(lambda: to_gigabyte(psutil.virtual_memory().used))
-load_stats = DataStatistic(lambda: 100 * psutil.getloadavg()[0] / cpu_count)
+if (args.replay or args.diff) and np is None:
+    print(f'{sys.argv[0]}: install the numpy module to work with traces', file=sys.stderr)
+    sys.exit(1)
+
+live = not args.replay and not args.diff
+if args.used_cpus is None and live:
+    args.used_cpus = cpu_count
+args.process_frequency = min(args.process_frequency, args.frequency)
+
+trace = TraceWriter(args.trace) if args.trace and live else None
+samples = Samples(trace)
+run_info = {
+    'hostname': os.uname()[1].split('.')[0],
+    'cpu_count': cpu_count,
+    'used_cpus': args.used_cpus,
+    'total_memory': to_gigabyte(psutil.virtual_memory().total),
+    'disk_total': disk_data_total,
+    'disk_start': disk_data_start,
+    'frequency': args.frequency,
+    'process_frequency': args.process_frequency,
+    # PSS splits pages shared e.g. by the forked WPA streaming processes
+    'memory_accounting': 'pss' if os.path.exists('/proc/self/smaps_rollup') else 'rss',
+    'command': args.command1 if args.command1 else ' '.join(args.command),
+}
+if args.rss:
+    run_info['memory_accounting'] = 'rss'
+
+cpu_scale = cpu_count / args.used_cpus if live else 1
+# the sampling loop is paced by record(), prime the non-blocking measurement
+psutil.cpu_percent()
+cpu_stats = DataStatistic('cpu', lambda: psutil.cpu_percent() * cpu_scale)
+mem_stats = DataStatistic('memory', lambda: to_gigabyte(psutil.virtual_memory().used))
+load_stats = DataStatistic('load', lambda: 100 * psutil.getloadavg()[0] / cpu_count)
 
 collectors = [cpu_stats, mem_stats, load_stats]
 
 # Some LXC containers do not support disk IO counters:
 try:
     disk_read_stats = DiskDataStatistic(
-        lambda: to_megabyte((1 / INTERVAL) * (psutil.disk_io_counters().read_bytes))
+        'disk-read', lambda: to_megabyte((1 / INTERVAL) * (psutil.disk_io_counters().read_bytes))
     )
     disk_write_stats = DiskDataStatistic(
-        lambda: to_megabyte((1 / INTERVAL) * (psutil.disk_io_counters().write_bytes))
+        'disk-write', lambda: to_megabyte((1 / INTERVAL) * (psutil.disk_io_counters().write_bytes))
     )
     collectors.append(disk_read_stats)
     collectors.append(disk_write_stats)
@@ -183,10 +435,29 @@ except AttributeError:
     print('WARNING: disk IO counters not supported by the system')
     pass
 
+cgroup_files = get_cgroup_memory_files()
+cgroup_mem_stats = None
+if cgroup_files and live:
+    cgroup_mem_stats = DataStatistic(
+        'cgroup-memory', lambda: to_gigabyte(int(read_file(cgroup_files[0])))
+    )
+    collectors.append(cgroup_mem_stats)
+cgroup_peak_fd = open_cgroup_memory_peak(cgroup_files[1]) if cgroup_mem_stats else None
+
+pressure_stats = []
+if live:
+    for resource in PRESSURE_RESOURCES:
+        try:
+            pressure_stats.append(PressureStatistic(resource))
+        except OSError:
+            # PSI is not enabled in the kernel
+            pass
+    collectors += pressure_stats
+
 gpu_stats = None
 gpu_mem_stats = None
 
-if args.skip_gpu:
+if args.skip_gpu and live:
     try:
         import GPUtil
 
@@ -204,18 +475,16 @@ if args.skip_gpu:
                 # sometimes GPUtil.getGPUs() returns [] if we are terminating
                 return 0
 
-        gpu_stats = DataStatistic(collect_gpu)
+        gpu_stats = DataStatistic('gpu', collect_gpu)
         # the memory consumption is reported in MiBs
-        gpu_mem_stats = DataStatistic(collect_gpu_memory)
+        gpu_mem_stats = DataStatistic('gpu-memory', collect_gpu_memory)
         collectors.append(gpu_stats)
         collectors.append(gpu_mem_stats)
     except ImportError:
         print('WARNING: missing GPUtil package (pip install GPUtil)')
 
 
-def get_process_name(proc):
-    name = proc.name()
-    cmdline = proc.cmdline()
+def get_process_name(name, cmdline, pid):
     if name in ('ld', 'ld.gold', 'ld.lld', 'ld.mold'):
         return 'linker'
     elif name == 'lto1-wpa':
@@ -234,16 +503,21 @@ def get_process_name(proc):
         return 'rpm/rpm2cpio/dpkg'
     elif '-fltrans' in cmdline:
         if args.separate_ltrans:
-            return 'ltrans-%d' % proc.pid
+            return 'ltrans-%d' % pid
         else:
             return 'ltrans'
     return None
 
 
-def record_process_memory_hog(proc, memory, timestamp):
+def counts_memory(name):
+    # RSS of the WPA streaming processes is bogus, it mostly consists of pages shared (COW) with WPA
+    return name != 'WPA-stream-out' or run_info['memory_accounting'] == 'pss'
+
+
+def record_process_memory_hog(cmdline, memory, timestamp):
     if args.memory_hog_threshold:
         if memory >= args.memory_hog_threshold:
-            cmd = ' '.join(proc.cmdline())
+            cmd = ' '.join(cmdline)
             tpl = (memory, timestamp)
             if cmd not in process_hogs:
                 process_hogs[cmd] = tpl
@@ -251,118 +525,363 @@ def record_process_memory_hog(proc, memory, timestamp):
                 process_hogs[cmd] = tpl
 
 
+def read_proc_stat(pid):
+    """Return (comm, ppid, cpu ticks, start time, RSS in bytes, state) parsed from /proc/<pid>/stat."""
+    data = read_file(f'/proc/{pid}/stat')
+    # comm can contain spaces and parentheses
+    _, _, rest = data.partition(b' (')
+    comm, _, rest = rest.rpartition(b') ')
+    fields = rest.split()
+    return (
+        comm.decode(errors='replace'),
+        int(fields[1]),
+        int(fields[11]) + int(fields[12]),
+        int(fields[19]),
+        int(fields[21]) * PAGE_SIZE,
+        fields[0].decode(),
+    )
+
+
+class ProcSampler:
+    """Track all descendant processes directly from /proc.
+
+    Descendants are found via /proc/<pid>/task/<tid>/children (with a fallback to a scan
+    of all processes) and a single /proc/<pid>/stat read is done per process and poll.
+    Polling runs more often than sampling so that short processes are seen as well;
+    the spawn time comes from the process start time, the exit time is the first poll
+    that does not see the process (or sees it as a zombie).
+    Command line and get_process_name() classification are cached per process.
+    With a trace, processes and their samples are written to it.
+    """
+
+    def __init__(self, root_pid):
+        self.root_pid = root_pid
+        self.use_children = os.path.exists(f'/proc/{root_pid}/task/{root_pid}/children')
+        # (pid, start time) -> running process
+        self.processes = {}
+        self.finished = []
+        self.next_id = 0
+        self.process_samples = {name: array('d') for name in PROCESS_SAMPLE_COLUMNS}
+        self.polls = 0
+        self.last_poll = 0
+        # peak of the summed RSS of all descendants (the command's process tree)
+        self.peak_rss = 0
+        self.polling_time = 0
+        self.samples = 0
+        self.sampling_cpu_time = 0
+
+    def children_pids(self):
+        pids = []
+        queue = [self.root_pid]
+        while queue:
+            pid = queue.pop()
+            try:
+                tids = os.listdir(f'/proc/{pid}/task')
+            except OSError:
+                continue
+            for tid in tids:
+                try:
+                    children = read_file(f'/proc/{pid}/task/{tid}/children').split()
+                except OSError:
+                    continue
+                for child in children:
+                    pids.append(int(child))
+                    queue.append(int(child))
+        return pids
+
+    def scan_pids(self):
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    parents[int(entry)] = read_proc_stat(entry)[1]
+                except (OSError, ValueError, IndexError):
+                    pass
+        children = {}
+        for pid, ppid in parents.items():
+            children.setdefault(ppid, []).append(pid)
+        pids = []
+        queue = [self.root_pid]
+        while queue:
+            for child in children.get(queue.pop(), []):
+                pids.append(child)
+                queue.append(child)
+        return pids
+
+    def get_process(self, key, comm, ppid, parents):
+        process = self.processes.get(key)
+        if not process:
+            pid, start = key
+            parent = parents.get(ppid)
+            process = {
+                'id': self.next_id,
+                'pid': pid,
+                'parent': parent['id'] if parent else None,
+                'start': max(start / CLOCK_TICKS - BOOT_OFFSET - start_ts, 0),
+                'sample_ticks': 0,
+            }
+            process['sample_time'] = process['start']
+            self.processes[key] = process
+            self.next_id += 1
+        if process.get('comm') != comm:
+            # a new process or an exec of a different program (e.g. a fork of a shell)
+            pid = process['pid']
+            cmdline = read_file(f'/proc/{pid}/cmdline').decode(errors='replace').split('\0')[:-1]
+            process['comm'] = comm
+            process['cmdline'] = cmdline
+            if trace:
+                fields = ('id', 'pid', 'parent', 'comm', 'cmdline', 'start')
+                trace.write(dict({field: process[field] for field in fields}, type='process'))
+            process['name'] = get_process_name(comm, cmdline, pid)
+            process['peak_rss'] = 0
+            process['peak_time'] = process['start']
+        return process
+
+    def finish(self, process, timestamp):
+        process['end'] = timestamp
+        process['cpu_time'] = process['ticks'] / CLOCK_TICKS
+        record_process_memory_hog(
+            process['cmdline'], to_gigabyte(process['peak_rss']), process['peak_time']
+        )
+        if trace:
+            trace.write(
+                {
+                    'type': 'process-end',
+                    'id': process['id'],
+                    'end': process['end'],
+                    'cpu_time': process['cpu_time'],
+                    'peak_rss': process['peak_rss'],
+                    'peak_time': process['peak_time'],
+                }
+            )
+        self.finished.append(process)
+
+    def finish_pid(self, pid, timestamp):
+        """Finish a reaped process at the exact time of its exit."""
+        with lock:
+            for key in [key for key in self.processes if key[0] == pid]:
+                self.finish(self.processes.pop(key), timestamp)
+
+    def finish_all(self, timestamp):
+        with lock:
+            for process in self.processes.values():
+                self.finish(process, timestamp)
+            self.processes = {}
+            self.flush()
+
+    def flush(self):
+        if trace and self.process_samples['sample']:
+            trace.write({'type': 'process-samples'}, self.process_samples)
+            self.process_samples = {name: array('d') for name in PROCESS_SAMPLE_COLUMNS}
+
+    def poll(self, timestamp):
+        """Look for started and finished descendants and update their CPU ticks and RSS."""
+        start_time = time.monotonic()
+        start_cpu_time = time.thread_time()
+
+        pids = self.children_pids() if self.use_children else self.scan_pids()
+        # pid -> running process, parents are visited before their children
+        running = {}
+        alive = set()
+        with lock:
+            for pid in pids:
+                try:
+                    comm, ppid, ticks, start, rss, state = read_proc_stat(pid)
+                    key = (pid, start)
+                    process = self.get_process(key, comm, ppid, running)
+                except (OSError, ValueError, IndexError):
+                    # the process can be gone
+                    continue
+                process['ticks'] = ticks
+                process['rss'] = rss
+                if rss > process['peak_rss']:
+                    process['peak_rss'] = rss
+                    process['peak_time'] = timestamp
+                # a zombie has already exited, it only waits for its parent
+                if state != 'Z':
+                    running[pid] = process
+                    alive.add(key)
+
+            for key in [key for key in self.processes if key not in alive]:
+                self.finish(self.processes.pop(key), timestamp)
+            self.peak_rss = max(self.peak_rss, sum(process['rss'] for process in running.values()))
+
+        self.polls += 1
+        self.last_poll = timestamp
+        self.polling_time += time.monotonic() - start_time
+        self.sampling_cpu_time += time.thread_time() - start_cpu_time
+
+    def sample(self, index, timestamp):
+        """Return a list of (cmdline, name, memory in bytes, CPU usage in %) for all running descendants.
+
+        The memory is PSS for the classified processes unless RSS accounting is selected.
+        """
+        start_cpu_time = time.thread_time()
+        result = []
+        with lock:
+            for process in self.processes.values():
+                cpu = 0
+                if timestamp > process['sample_time']:
+                    ticks = process['ticks'] - process['sample_ticks']
+                    cpu = 100 * ticks / CLOCK_TICKS / (timestamp - process['sample_time'])
+                process['sample_ticks'] = process['ticks']
+                process['sample_time'] = timestamp
+                pss = 0
+                if process['name'] and run_info['memory_accounting'] == 'pss':
+                    try:
+                        pss = read_pss(process['pid'])
+                    except OSError:
+                        # the process can be gone
+                        pass
+                if trace:
+                    values = (index, process['id'], process['rss'], pss, cpu)
+                    for name, value in zip(PROCESS_SAMPLE_COLUMNS, values):
+                        self.process_samples[name].append(value)
+                memory = pss if run_info['memory_accounting'] == 'pss' else process['rss']
+                result.append((process['cmdline'], process['name'], memory, cpu))
+            if len(self.process_samples['sample']) >= 16 * SPILL_SAMPLES:
+                self.flush()
+
+        self.samples += 1
+        self.sampling_cpu_time += time.thread_time() - start_cpu_time
+        return result
+
+    def overhead(self):
+        timestamps = samples.column('timestamp')
+        duration = timestamps[-1] if timestamps else 0
+        rate = (self.samples - 1) / duration if duration else 0
+        poll_rate = (self.polls - 1) / self.last_poll if self.last_poll else 0
+        cpu_usage = 100 * self.sampling_cpu_time / self.last_poll if self.last_poll else 0
+        tick = 1000 * self.polling_time / self.polls if self.polls else 0
+        return (
+            f'samples: {self.samples}; rate: {rate:.1f}/{1 / args.frequency:.1f} Hz (achieved/requested);'
+            f' process polling: {poll_rate:.1f}/{1 / args.process_frequency:.1f} Hz,'
+            f' {tick:.2f} ms per poll, CPU {cpu_usage:.2f}% of a core;'
+        )
+
+
+sampler = ProcSampler(os.getpid())
+
+
 def record():
-    active_pids = {}
+    next_poll = next_sample = time.monotonic()
+    index = 0
     while not done:
-        timestamp = time.monotonic() - start_ts
-        timestamps.append(timestamp)
-        for stat in collectors:
-            stat.collect()
-
-        entry = {}
-        seen_pids = set()
-        for proc in psutil.Process().children(recursive=True):
-            try:
-                memory = to_gigabyte(proc.memory_info().rss)
-                record_process_memory_hog(proc, memory, timestamp)
-                name = get_process_name(proc)
+        sampler.poll(time.monotonic() - start_ts)
+        now = time.monotonic()
+        if now >= next_sample:
+            timestamp = now - start_ts
+            row = {'timestamp': timestamp}
+            for stat in collectors:
+                row[stat.name] = stat.collect()
+
+            entry = {}
+            for _, name, memory, cpu in sampler.sample(index, timestamp):
+                memory = to_gigabyte(memory)
                 if name:
-                    seen_pids.add(proc.pid)
-                    if proc.pid not in active_pids:
-                        active_pids[proc.pid] = proc
-                    else:
-                        proc = active_pids[proc.pid]
-                    cpu = proc.cpu_percent() / args.used_cpus
+                    cpu /= args.used_cpus
                     if name not in process_name_map:
                         length = len(process_name_map)
                         process_name_map[name] = length
                     if name not in entry:
                         entry[name] = {'memory': 0, 'cpu': 0}
                     entry[name]['cpu'] += cpu
-                    # FIXME: ignore WPA streaming memory - COW makes it bogus
-                    if name != 'WPA-stream-out':
+                    if counts_memory(name):
                         entry[name]['memory'] += memory
-            except Exception:
-                # the process can be gone
-                pass
-        for pid in list(active_pids.keys()):
-            if pid not in seen_pids:
-                del active_pids[pid]
-        if args.verbose:
-            print(entry, flush=True)
-        if not args.summary_only:
-            process_usage.append(entry)
-
-
-def stack_values(process_usage, key):
-    stacks = []
-    for _ in range(len(process_name_map)):
-        stacks.append([])
-    for values in process_usage:
-        for k, v in process_name_map.items():
-            if k in values:
-                stacks[v].append(values[k][key])
-            else:
-                stacks[v].append(0)
+            if args.verbose:
+                print(entry, flush=True)
+            if not args.summary_only:
+                for name, values in entry.items():
+                    row[f'memory:{name}'] = values['memory']
+                    row[f'cpu:{name}'] = values['cpu']
+            samples.append(row)
+            index += 1
+            # do not try to catch up when we are late
+            next_sample = max(next_sample + args.frequency, now)
+
+        next_poll += args.process_frequency
+        delay = min(next_poll, next_sample) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # we are late, do not try to catch up
+            next_poll = time.monotonic()
+
+
+def stack_values(key):
+    stacks = np.zeros((len(process_name_map), samples.length))
+    for name, index in process_name_map.items():
+        column = f'{key}:{name}'
+        if column in samples.columns:
+            stacks[index] = samples.array(column)
     return stacks
 
 
+def format_optional(value):
+    return f'{value:.1f}' if value is not None else 'n/a'
+
+
 def get_footnote():
-    hostname = os.uname()[1].split('.')[0]
+    hostname = run_info['hostname']
     cpu_average = cpu_stats.average()
     cpu_max = cpu_stats.maximum()
     peak_memory = mem_stats.maximum()
-    total_mem = to_gigabyte(psutil.virtual_memory().total)
+    total_mem = run_info['total_memory']
+    cgroup_line = ''
+    if cgroup_mem_stats:
+        cgroup_peak = run_info.get('cgroup_memory_peak', cgroup_mem_stats.maximum())
+        cgroup_line = f' enclosing cgroup RAM peak: {cgroup_peak:.1f} GiB;'
     gpu_line = ''
     if gpu_stats:
-        total_gpu_mem = GPUtil.getGPUs()[0].memoryTotal / 1024
+        total_gpu_mem = format_optional(run_info.get('gpu_memory_total'))
         gpu_line = f' GPU avg/max: {gpu_stats.average():.1f}/{gpu_stats.maximum():.1f};'
-        gpu_line += f' GPU RAM: peak/total: {gpu_mem_stats.maximum():.1f}/{total_gpu_mem:.1f} GiB;'
+        gpu_line += f' GPU RAM: peak/total: {gpu_mem_stats.maximum():.1f}/{total_gpu_mem} GiB;'
     return (
-        f'host: {hostname}; CPUs: {args.used_cpus}/{cpu_count};'
+        f'host: {hostname}; CPUs: {args.used_cpus}/{run_info["cpu_count"]};'
         f' CPU avg/max: {cpu_average:.1f}/{cpu_max:.1f}%;'
         f' RAM peak/total: {peak_memory:.1f}/{total_mem:.1f} GiB;'
-        f'{gpu_line}'
+        f'{cgroup_line}{gpu_line}'
     )
 
 
 def get_footnote2():
-    disk_total = disk_data_total
-    disk_start = disk_data_start
-    disk_end = to_gigabyte(psutil.disk_usage('.').used)
-    total_read = disk_read_stats.difference_in_gb() if disk_read_stats else 0
-    total_written = disk_write_stats.difference_in_gb() if disk_write_stats else 0
+    disk_total = run_info['disk_total']
+    disk_start = run_info['disk_start']
+    # end-of-run values are missing in a trace of an interrupted run
+    disk_end = format_optional(run_info.get('disk_end'))
+    total_read = disk_total_in_gb(disk_read_stats) if disk_read_stats else 0
+    total_written = disk_total_in_gb(disk_write_stats) if disk_write_stats else 0
     load_max = load_stats.maximum()
-    ts = str(datetime.datetime.now())
-    # strip second fraction part
-    ts = ts[: ts.rindex('.')]
+    ts = run_info.get('created', 'n/a')
     return (
-        f'taken: {int(timestamps[-1])} s; created: {ts};'
+        f'taken: {int(samples.column("timestamp")[-1])} s; created: {ts};'
         f' load max (1m): {load_max:.0f}%;'
-        f' disk start/end/total: {disk_start:.1f}/{disk_end:.1f}/{disk_total:.1f} GiB;'
+        f' disk start/end/total: {disk_start:.1f}/{disk_end}/{disk_total:.1f} GiB;'
         f' total read/write: {total_read:.1f}/{total_written:.1f} GiB;'
     )
 
 
 def generate_graph():
     peak_memory = mem_stats.maximum()
+    timestamps = samples.array('timestamp')
 
-    fig, (cpu_subplot, mem_subplot, disk_subplot) = plt.subplots(3, sharex=True)
+    fig, subplots = plt.subplots(4 if pressure_stats else 3, sharex=True)
+    cpu_subplot, mem_subplot, disk_subplot = subplots[:3]
     title = args.title if args.title else ''
     fig.suptitle(title, fontsize=17)
-    fig.set_figheight(8)
+    fig.set_figheight(10 if pressure_stats else 8)
     fig.set_figwidth(10)
     # scale cpu axis
     local_peak_cpu = max(
-        cpu_stats.values + load_stats.values + (gpu_stats.values if gpu_stats else [])
+        cpu_stats.maximum(), load_stats.maximum(), gpu_stats.maximum() if gpu_stats else 0
     )
     cpu_ylimit = (local_peak_cpu // 10) * 11 + 5
     if cpu_ylimit > 300:
         cpu_ylimit = 300
     cpu_subplot.set_title('CPU usage')
     cpu_subplot.set_ylabel('%')
-    cpu_subplot.plot(timestamps, cpu_stats.values, c='blue', lw=LW, label='total')
-    cpu_subplot.plot(timestamps, load_stats.values, c='cyan', lw=LW, label='load')
+    cpu_subplot.plot(timestamps, cpu_stats.array(), c='blue', lw=LW, label='total')
+    cpu_subplot.plot(timestamps, load_stats.array(), c='cyan', lw=LW, label='load')
     cpu_subplot.set_ylim([0, cpu_ylimit])
     cpu_subplot.axhline(
         color='r',
@@ -375,21 +894,34 @@ def generate_graph():
     cpu_subplot.set_xlim(left=0)
     cpu_subplot.grid(True)
 
-    mem_subplot.plot(timestamps, mem_stats.values, c='blue', lw=LW, label='total')
-    mem_subplot.set_title('Memory usage')
+    mem_subplot.plot(timestamps, mem_stats.array(), c='blue', lw=LW, label='total')
+    mem_subplot.set_title(f'Memory usage ({run_info["memory_accounting"].upper()} of processes)')
     mem_subplot.set_ylabel('GiB')
     if gpu_stats:
-        mem_subplot.plot(timestamps, gpu_mem_stats.values, c='fuchsia', lw=LW, label='GPU')
+        mem_subplot.plot(timestamps, gpu_mem_stats.array(), c='fuchsia', lw=LW, label='GPU')
+    if cgroup_mem_stats:
+        mem_subplot.plot(
+            timestamps, cgroup_mem_stats.array(), c='orange', lw=LW, label='enclosing cgroup'
+        )
 
     if disk_read_stats:
-        disk_subplot.plot(timestamps, disk_read_stats.values, c='green', lw=LW, label='read')
-        disk_subplot.plot(timestamps, disk_write_stats.values, c='red', lw=LW, label='write')
+        disk_subplot.plot(timestamps, disk_read_stats.array(), c='green', lw=LW, label='read')
+        disk_subplot.plot(timestamps, disk_write_stats.array(), c='red', lw=LW, label='write')
     disk_subplot.set_title('Disk read/write')
     disk_subplot.set_ylabel('MiB/s')
-    disk_subplot.set_xlabel('time')
+    subplots[-1].set_xlabel('time')
+
+    if pressure_stats:
+        pressure_subplot = subplots[3]
+        for stat in pressure_stats:
+            pressure_subplot.plot(timestamps, stat.array(), c=stat.color, lw=LW, label=stat.name)
+        pressure_subplot.set_title('Pressure stall (some tasks)')
+        pressure_subplot.set_ylabel('%')
+        pressure_subplot.set_ylim([0, 105])
+        pressure_subplot.grid(True)
 
     if gpu_stats:
-        cpu_subplot.plot(timestamps, gpu_stats.values, c='fuchsia', lw=LW, label='GPU')
+        cpu_subplot.plot(timestamps, gpu_stats.array(), c='fuchsia', lw=LW, label='GPU')
 
     # scale it to a reasonable limit
     limit = 1
@@ -412,9 +944,9 @@ def generate_graph():
         if name in process_name_map:
             colors[process_name_map[name]] = color
 
-    mem_stacks = stack_values(process_usage, 'memory')
-    cpu_stacks = stack_values(process_usage, 'cpu')
-    if mem_stacks:
+    mem_stacks = stack_values('memory')
+    cpu_stacks = stack_values('cpu')
+    if mem_stacks.size:
         mem_subplot.stackplot(timestamps, mem_stacks, colors=colors)
         cpu_subplot.stackplot(timestamps, cpu_stacks, colors=colors)
 
@@ -423,6 +955,9 @@ def generate_graph():
         if gpu_stats:
             names += ['GPU: total']
         names += ['disk: read', 'disk: write']
+        if cgroup_mem_stats:
+            names += ['RAM: enclosing cgroup']
+        names += [f'stall: {stat.resource}' for stat in pressure_stats]
 
         custom_lines = []
         custom_lines.append(Line2D([0], [0], color='r', alpha=0.5, linestyle='dotted', lw=LW))
@@ -432,8 +967,12 @@ def generate_graph():
             custom_lines.append(Line2D([0], [0], color='fuchsia', lw=LW))
         custom_lines.append(Line2D([0], [0], color='green', lw=LW))
         custom_lines.append(Line2D([0], [0], color='red', lw=LW))
+        if cgroup_mem_stats:
+            custom_lines.append(Line2D([0], [0], color='orange', lw=LW))
+        for stat in pressure_stats:
+            custom_lines.append(Line2D([0], [0], color=stat.color, lw=LW))
 
-        if sum(chain(*cpu_stacks)) > 0:
+        if cpu_stacks.sum() > 0:
             colors = special_processes.values()
             custom_lines += [Line2D([0], [0], color=x, lw=5) for x in colors]
             names += list(special_processes.keys())
@@ -448,43 +987,308 @@ def generate_graph():
         print('Saving plot to %s' % filename)
 
 
-def summary():
+def critical_path(processes, end, tolerance):
+    """Return the longest serial chain of processes as (process, start, end) parts.
+
+    Walking back from the end of a process, its child that finished last is on the path,
+    then the child that finished last before that one started and so on. Children are
+    expanded into their own chains and the time not covered by any child is attributed
+    to the parent itself (None stands for the wrapper). A child that finished within
+    the tolerance after the start of the next one is still considered serial.
+    """
+    children = {}
+    for process in processes:
+        if 'end' in process:
+            children.setdefault(process['parent'], []).append(process)
+    for siblings in children.values():
+        siblings.sort(key=lambda process: process['end'])
+
+    def expand(parent, start, end):
+        chain = []
+        cursor = end
+        for child in reversed(children.get(parent['id'] if parent else None, [])):
+            if child['end'] <= cursor + tolerance or not chain:
+                if child['end'] < cursor:
+                    chain.append((parent, child['end'], cursor))
+                chain += reversed(expand(child, child['start'], child['end']))
+                cursor = child['start']
+        if cursor > start:
+            chain.append((parent, start, cursor))
+        return list(reversed(chain))
+
+    # merge adjacent parts of the same process
+    path = []
+    for process, part_start, part_end in expand(None, 0, end):
+        if path and path[-1][0] is process:
+            path[-1] = (process, path[-1][1], part_end)
+        else:
+            path.append((process, part_start, part_end))
+    return path
+
+
+def print_critical_path(processes):
+    duration = samples.column('timestamp')[-1] if samples.length else 0
+    # an exit is seen by the next poll, a start time is rounded down to clock ticks
+    path = critical_path(processes, duration, 2 * run_info['process_frequency'])
+    print(f'CRITICAL PATH (wall time: {duration:.1f} s):')
+    skipped = 0
+    for process, start, end in path:
+        if end - start < CRITICAL_PATH_MIN:
+            skipped += end - start
+            continue
+        if process:
+            name = get_process_name(process['comm'], process['cmdline'], process['pid'])
+            cmdline = ' '.join(process['cmdline'])
+            details = (
+                f' (CPU: {process.get("cpu_time", 0):.1f} s,'
+                f' peak: {to_gigabyte(process["peak_rss"]):.1f} GiB)'
+            )
+            label = f'{name or process["comm"]}: {cmdline[:80]}{details}'
+        else:
+            label = 'no process'
+        print(f'  {start:8.1f} s {end - start:8.1f} s: {label}')
+    if skipped >= CRITICAL_PATH_MIN:
+        print(f'  {skipped:.1f} s in parts shorter than {CRITICAL_PATH_MIN} s')
+
+
+def summary(processes):
     print()
     print(f'SUMMARY: {get_footnote()}')
     print(f'SUMMARY: {get_footnote2()}')
+    if live:
+        print(f'SAMPLER: {sampler.overhead()}')
     if process_hogs:
         print(f'PROCESS MEMORY HOGS (>={args.memory_hog_threshold:.1f} GiB):')
         items = sorted(process_hogs.items(), key=lambda x: x[1][0], reverse=True)
         for cmdline, (memory, ts) in items:
             print(f'  {memory:.1f} GiB: {ts:.1f} s: {cmdline}')
-
-
+    if 'rusage' in run_info:
+        rusage = run_info['rusage']
+        # ru_maxrss is inherited over fork+exec and includes the wrapper, use the sampled peak
+        rss_line = ''
+        if 'peak_rss' in run_info:
+            peak_rss = to_gigabyte(run_info['peak_rss'])
+            rss_line = f' peak RSS of processes (sampled): {peak_rss:.1f} GiB;'
+        print(f'COMMAND: CPU user/system: {rusage["user"]:.1f}/{rusage["system"]:.1f} s;{rss_line}')
+    if args.critical_path:
+        print_critical_path(processes)
+
+
+def render(processes):
+    if not mem_stats.empty():
+        min_memory = mem_stats.minimum()
+        if not args.base_memory:
+            mem_stats.values = [x - min_memory for x in mem_stats.values]
+        if not args.summary_only:
+            generate_graph()
+    summary(processes)
+
+
+def load_trace(path):
+    """Return run info, samples, processes and process samples stored in a trace."""
+    info = {}
+    trace_samples = Samples()
+    processes = {}
+    process_samples = {}
+    for record, columns in read_trace(path):
+        kind = record['type']
+        if kind == 'metadata':
+            info.update(record['data'])
+        elif kind == 'samples':
+            trace_samples.extend(columns, record['length'])
+        elif kind == 'process':
+            processes[record['id']] = record
+        elif kind == 'process-end':
+            processes[record['id']].update(record)
+        elif kind == 'process-samples':
+            for name, values in columns.items():
+                process_samples.setdefault(name, array('d')).extend(values)
+    process_samples = {name: np.frombuffer(values) for name, values in process_samples.items()}
+    info.setdefault('memory_accounting', 'rss')
+    if args.rss:
+        info['memory_accounting'] = 'rss'
+    return (info, trace_samples, processes, process_samples)
+
+
+def category_usage(processes, process_samples, length, accounting):
+    """Classify the traced processes and sum their memory (bytes) and CPU (%) per category and sample."""
+    names = {}
+    for id, process in sorted(processes.items()):
+        names[id] = get_process_name(process['comm'], process['cmdline'], process['pid'])
+    categories = list(dict.fromkeys(name for name in names.values() if name))
+
+    lookup = np.full(max(names, default=0) + 1, -1)
+    for id, name in names.items():
+        if name:
+            lookup[id] = categories.index(name)
+    if 'process' not in process_samples:
+        return {}
+    category = lookup[process_samples['process'].astype(int)]
+    index = process_samples['sample'].astype(int)
+
+    usage = {}
+    for i, name in enumerate(categories):
+        selected = category == i
+        memory = np.bincount(index[selected], process_samples[accounting][selected], length)
+        cpu = np.bincount(index[selected], process_samples['cpu'][selected], length)
+        usage[name] = (memory, cpu, len({id for id in names if names[id] == name}))
+    return usage
+
+
+def replay(path):
+    global samples, gpu_stats, gpu_mem_stats, disk_read_stats, disk_write_stats, cgroup_mem_stats
+
+    info, samples, processes, process_samples = load_trace(path)
+    run_info.update(info)
+    if args.used_cpus is None:
+        args.used_cpus = run_info['used_cpus']
+    elif args.used_cpus != run_info['used_cpus']:
+        scale = run_info['used_cpus'] / args.used_cpus
+        samples.columns['cpu'] = array('d', (samples.array('cpu') * scale).tobytes())
+
+    # categories are computed again from the processes, e.g. with a different --separate-ltrans
+    for name in [name for name in samples.columns if name.startswith(('memory:', 'cpu:'))]:
+        del samples.columns[name]
+    accounting = run_info['memory_accounting']
+    usage = category_usage(processes, process_samples, samples.length, accounting)
+    for name, (memory, cpu, _) in usage.items():
+        if name not in process_name_map:
+            process_name_map[name] = len(process_name_map)
+        if counts_memory(name):
+            samples.columns[f'memory:{name}'] = array('d', to_gigabyte(memory).tobytes())
+        samples.columns[f'cpu:{name}'] = array('d', (cpu / args.used_cpus).tobytes())
+
+    for process in processes.values():
+        if 'peak_rss' in process:
+            record_process_memory_hog(
+                process['cmdline'], to_gigabyte(process['peak_rss']), process['peak_time']
+            )
+
+    if 'gpu' in samples.columns:
+        gpu_stats = DataStatistic('gpu', None)
+        gpu_mem_stats = DataStatistic('gpu-memory', None)
+    if 'disk-read' not in samples.columns:
+        disk_read_stats = None
+        disk_write_stats = None
+    if 'cgroup-memory' in samples.columns:
+        cgroup_mem_stats = DataStatistic('cgroup-memory', None)
+    for resource in PRESSURE_RESOURCES:
+        if f'pressure-{resource}' in samples.columns:
+            pressure_stats.append(PressureStatistic(resource, replay=True))
+    render(list(processes.values()))
+
+
+def trace_summary(path):
+    """Return (overall metrics, per-category metrics) of a trace."""
+    info, trace_samples, processes, process_samples = load_trace(path)
+    timestamps = trace_samples.array('timestamp')
+    # time covered by each sample
+    durations = np.diff(timestamps, prepend=0)
+    memory = trace_samples.array('memory')
+    if not args.base_memory and memory.size:
+        memory = memory - memory.min()
+    overall = {
+        'duration (s)': timestamps[-1] if timestamps.size else 0,
+        'CPU avg (%)': trace_samples.array('cpu').mean() if timestamps.size else 0,
+        'RAM peak (GiB)': memory.max(initial=0),
+    }
+    categories = {}
+    for resource in PRESSURE_RESOURCES:
+        if f'pressure-{resource}' in trace_samples.columns:
+            stall = trace_samples.array(f'pressure-{resource}')
+            overall[f'{resource} stall avg (%)'] = stall.mean()
+    if 'cgroup-memory' in trace_samples.columns:
+        overall['enclosing cgroup RAM peak (GiB)'] = info.get(
+            'cgroup_memory_peak', trace_samples.array('cgroup-memory').max()
+        )
+    length = trace_samples.length
+    usage = category_usage(processes, process_samples, length, info['memory_accounting'])
+    for name, (memory, cpu, count) in usage.items():
+        categories[name] = {
+            'CPU (core-s)': (cpu / 100 * durations).sum(),
+            'RAM peak (GiB)': to_gigabyte(memory.max(initial=0)),
+            'processes': count,
+        }
+    return (overall, categories)
+
+
+def diff(path_a, path_b):
+    overall_a, categories_a = trace_summary(path_a)
+    overall_b, categories_b = trace_summary(path_b)
+
+    def print_row(label, a, b):
+        change = f'{100 * (b - a) / a:+.1f}%' if a else ''
+        print(f'{label:40} {a:12.1f} {b:12.1f} {change:>9}')
+
+    print(f'{"":40} {"A":>12} {"B":>12} {"change":>9}')
+    for key in dict.fromkeys(list(overall_a) + list(overall_b)):
+        print_row(key, overall_a.get(key, 0), overall_b.get(key, 0))
+    for name in dict.fromkeys(list(categories_a) + list(categories_b)):
+        for key in ('CPU (core-s)', 'RAM peak (GiB)', 'processes'):
+            a = categories_a.get(name, {}).get(key, 0)
+            b = categories_b.get(name, {}).get(key, 0)
+            print_row(f'{name}: {key}', a, b)
+
+
+if args.replay:
+    replay(args.replay)
+    sys.exit(0)
+elif args.diff:
+    diff(*args.diff)
+    sys.exit(0)
+
+if trace:
+    trace.write({'type': 'metadata', 'data': run_info})
 thread = threading.Thread(target=record, args=())
 thread.start()
 
 if args.verbose:
     print('Running command', flush=True)
 
-cp = None
+proc = None
+rv = None
 try:
     if args.command1:
-        cp = subprocess.run(args.command1, shell=True)
+        proc = subprocess.Popen(args.command1, shell=True)
     else:
-        cp = subprocess.run(args.command)
+        proc = subprocess.Popen(args.command)
+    # wait4 gives the exact exit time and resource usage of the command and its waited children
+    _, status, rusage = os.wait4(proc.pid, 0)
+    sampler.finish_pid(proc.pid, time.monotonic() - start_ts)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    run_info['rusage'] = {
+        'user': rusage.ru_utime,
+        'system': rusage.ru_stime,
+    }
 except KeyboardInterrupt:
     rv = 2
+    # unlike subprocess.run, wait4 leaves the command running
+    if proc and proc.returncode is None:
+        proc.kill()
+        proc.wait()
 finally:
     done = True
     thread.join()
-    if not mem_stats.empty():
-        min_memory = mem_stats.minimum()
-        if not args.base_memory:
-            mem_stats.values = [x - min_memory for x in mem_stats.values]
-        if not args.summary_only:
-            generate_graph()
-    summary()
-    if cp:
-        rv = cp.returncode
+    sampler.finish_all(time.monotonic() - start_ts)
+    run_info['peak_rss'] = sampler.peak_rss
+    ts = str(datetime.datetime.now())
+    # strip second fraction part
+    run_info['created'] = ts[: ts.rindex('.')]
+    run_info['disk_end'] = to_gigabyte(psutil.disk_usage('.').used)
+    if gpu_stats:
+        run_info['gpu_memory_total'] = GPUtil.getGPUs()[0].memoryTotal / 1024
+    # without a reset memory.peak, the sampled maximum is used
+    if cgroup_peak_fd is not None:
+        run_info['cgroup_memory_peak'] = to_gigabyte(int(os.pread(cgroup_peak_fd, 64, 0)))
+        os.close(cgroup_peak_fd)
+    if trace:
+        trace.write({'type': 'metadata', 'data': run_info})
+        samples.spill()
+        trace.close()
+        samples.load(args.trace)
+    render(sampler.finished)
+    if rv is None and proc and proc.returncode is not None:
+        rv = proc.returncode
 
 if rv != 0:
     print(f'\nWARNING: non-zero return code returned: {rv}')